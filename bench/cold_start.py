@@ -0,0 +1,100 @@
+"""
+cold_start.py
+October 18, 2026
+
+Measures how long a fresh process takes to import what the web process and
+the worker's jobs need, each in a new interpreter, like a gunicorn worker
+booting or an RQ work horse loading its first job. With --ref the same is
+measured for an earlier commit, exported to a temporary directory.
+
+    python bench/cold_start.py --runs 10
+    python bench/cold_start.py --runs 10 --ref HEAD~1
+
+Releases that connect at import need the DATABASE_URL and REDIS_URL the app
+uses.
+"""
+import os
+import sys
+import tarfile
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each kind of process imports, with the fallback for releases that
+# registered the routes when teamdict was imported
+TARGETS = {
+    'web': ['teamdict.wsgi', 'teamdict'],
+    'worker job': ['teamdict.util'],
+}
+
+SNIPPET = '''
+import time, importlib
+start = time.perf_counter()
+importlib.import_module({module!r})
+print(time.perf_counter() - start)
+'''
+
+def has_module(tree, module):
+    path = os.path.join(tree, *module.split('.'))
+    return os.path.isdir(path) or os.path.exists(path + '.py')
+
+def time_import(tree, module):
+    """Import a module in a new interpreter and return the seconds taken."""
+    result = subprocess.run([sys.executable, '-c',
+                             SNIPPET.format(module=module)],
+                            cwd=tree, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip())
+
+def measure(tree, runs):
+    results = {}
+    for name, modules in TARGETS.items():
+        module = next(m for m in modules if has_module(tree, m))
+        try:
+            samples = sorted(time_import(tree, module) for i in range(runs))
+        except RuntimeError as e:
+            results[name] = (module, None, str(e))
+            continue
+        results[name] = (module, samples, None)
+    return results
+
+def export(ref, directory):
+    """Write the tree of a commit into a directory."""
+    archive = subprocess.run(['git', 'archive', ref], cwd=ROOT,
+                             stdout=subprocess.PIPE, check=True).stdout
+    path = os.path.join(directory, 'tree.tar')
+    with open(path, 'wb') as f:
+        f.write(archive)
+    with tarfile.open(path) as tar:
+        tar.extractall(directory)
+    os.remove(path)
+
+def report(label, results):
+    for name, (module, samples, error) in results.items():
+        if samples is None:
+            print(f'{label:10}{name:12}{module:16}  failed: {error}')
+            continue
+        median = samples[len(samples) // 2] * 1000
+        print(f'{label:10}{name:12}{module:16}  median {median:8.1f} ms  '
+              f'min {samples[0] * 1000:8.1f} ms  '
+              f'max {samples[-1] * 1000:8.1f} ms')
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Measure the import time of a cold process.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--ref', help='also measure this commit')
+    args = parser.parse_args(argv)
+
+    if args.ref:
+        with tempfile.TemporaryDirectory() as directory:
+            export(args.ref, directory)
+            report(args.ref, measure(directory, args.runs))
+    report('current', measure(ROOT, args.runs))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+"""
+job_payload.py
+October 18, 2026
+
+Measures what a queued /lookup costs in Redis before and after jobs were
+given compact envelopes: the size of the pickled job RQ stores, the time to
+build and pickle it when enqueueing, and the time to unpickle and decode it
+in the worker. The old job pickled a JobData holding every header, the full
+form and the raw body of a typical Slack request, rebuilt here.
+
+    python bench/job_payload.py
+    python bench/job_payload.py --redis    # also ask Redis for MEMORY USAGE
+
+Only --redis needs a server, at REDIS_URL.
+"""
+import os
+import sys
+import pickle
+import timeit
+import argparse
+import importlib.util
+from functools import partial
+from urllib.parse import urlencode
+
+# Load envelope.py on its own; it needs nothing from the app
+ENVELOPE_PATH = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'teamdict', 'envelope.py')
+spec = importlib.util.spec_from_file_location('envelope', ENVELOPE_PATH)
+envelope = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(envelope)
+
+# RQ stores jobs pickled this way
+dumps = partial(pickle.dumps, protocol=pickle.HIGHEST_PROTOCOL)
+FUNC_NAME = 'teamdict.util.triage_command'
+
+class LegacyJobData:
+    """The JobData RQ used to pickle for every command."""
+    def __init__(self, headers, form, body, job_type, url='', data={}):
+        self.headers = headers
+        self.form = form
+        self.body = body
+        self.job_type = job_type
+        self.url = url
+        self.data = data
+
+def sample_request():
+    """The headers and form of a /lookup as it reaches the app on Heroku."""
+    form = {
+        'token': 'gIkuvaNzQIHg97ATvDxqgjtO',
+        'team_id': 'T0001',
+        'team_domain': 'example',
+        'enterprise_id': 'E0001',
+        'enterprise_name': 'Globular Construct Inc',
+        'channel_id': 'C2147483705',
+        'channel_name': 'general',
+        'user_id': 'U2147483697',
+        'user_name': 'steve',
+        'command': '/lookup',
+        'text': 'deploy-checklist runbooks',
+        'response_url': 'https://hooks.slack.com/commands/T0001/1234567890/'
+                        'abcdefghijklmnopqrstuvwx',
+        'trigger_id': '13345224609.738474920.8088930838d88f008e0',
+        'api_app_id': 'A123456',
+    }
+    body = urlencode(form)
+    headers = {
+        'Host': 'teamdict.herokuapp.com',
+        'Connection': 'close',
+        'User-Agent': 'Slackbot 1.0 (+https://api.slack.com/robots)',
+        'Accept-Encoding': 'gzip,deflate',
+        'Accept': 'application/json,*/*',
+        'X-Slack-Signature': 'v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10b'
+                             'd27519666489c69b503',
+        'X-Slack-Request-Timestamp': '1531420618',
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'X-Request-Id': '6c1b4b9c-3f0f-4d0a-9b47-5bb3cbd4b0f1',
+        'X-Forwarded-For': '54.209.66.114',
+        'X-Forwarded-Proto': 'https',
+        'X-Forwarded-Port': '443',
+        'Via': '1.1 vegur',
+        'Connect-Time': '0',
+        'X-Request-Start': '1531420618112',
+        'Total-Route-Time': '0',
+        'Content-Length': str(len(body)),
+    }
+    return headers, form, body
+
+def legacy_enqueue(headers, form, body):
+    job_data = LegacyJobData(headers, form, body, 'lookup',
+                             url='https://teamdict.herokuapp.com/')
+    return dumps((FUNC_NAME, None, (job_data,), {}))
+
+def legacy_dequeue(data):
+    func_name, instance, args, kwargs = pickle.loads(data)
+    return args[0].form
+
+def envelope_enqueue(headers, form, body):
+    payload = envelope.pack('lookup', form,
+                            url='https://teamdict.herokuapp.com/')
+    return dumps((FUNC_NAME, None, (payload,), {}))
+
+def envelope_dequeue(data):
+    func_name, instance, args, kwargs = pickle.loads(data)
+    return envelope.unpack(args[0]).form
+
+def per_call_us(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+def redis_memory(data_by_name):
+    """Store each pickled job the way RQ does and ask Redis its size."""
+    import redis
+    conn = redis.from_url(os.getenv('REDIS_URL', 'redis://'))
+    sizes = {}
+    for name, data in data_by_name.items():
+        key = f'rq:job:bench-job-payload-{name}'
+        conn.hmset(key, {'data': data, 'origin': 'high',
+                         'description': FUNC_NAME, 'status': 'queued',
+                         'created_at': '2026-10-18T00:00:00.000000Z',
+                         'enqueued_at': '2026-10-18T00:00:00.000000Z',
+                         'timeout': '180'})
+        sizes[name] = conn.execute_command('MEMORY', 'USAGE', key)
+        conn.delete(key)
+    return sizes
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Compare legacy pickled JobData with job envelopes.')
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--redis', action='store_true',
+                        help='measure MEMORY USAGE of each job in Redis')
+    args = parser.parse_args(argv)
+
+    headers, form, body = sample_request()
+    legacy = legacy_enqueue(headers, form, body)
+    compact = envelope_enqueue(headers, form, body)
+    assert legacy_dequeue(legacy)['text'] == envelope_dequeue(compact)['text']
+
+    rows = [
+        ('pickled job bytes', len(legacy), len(compact)),
+        ('enqueue us', per_call_us(
+                lambda: legacy_enqueue(headers, form, body), args.number),
+            per_call_us(
+                lambda: envelope_enqueue(headers, form, body), args.number)),
+        ('dequeue us', per_call_us(
+                lambda: legacy_dequeue(legacy), args.number),
+            per_call_us(
+                lambda: envelope_dequeue(compact), args.number)),
+    ]
+    if args.redis:
+        sizes = redis_memory({'legacy': legacy, 'envelope': compact})
+        rows.append(('redis job bytes', sizes['legacy'], sizes['envelope']))
+
+    print(f'{"":20}{"legacy":>12}{"envelope":>12}{"change":>10}')
+    for name, before, after in rows:
+        change = (after - before) / before * 100
+        print(f'{name:20}{before:12.1f}{after:12.1f}{change:9.0f}%')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
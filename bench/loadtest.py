@@ -0,0 +1,318 @@
+"""
+loadtest.py
+October 18, 2026
+
+Load tests the Slack endpoints end to end against local Postgres and Redis.
+Requests are signed with the signing secret exactly as Slack signs them and
+sent through the Flask routes with the test client. Workers run as separate
+processes. A stub HTTP server stands in for Slack, both for the
+response_urls replies are sent to and for the Slack api.
+
+A request counts as done when its reply reaches the stub, or when the route
+answers it inline. For each command and dictionary size the report gives
+throughput and p50/p95/p99 latency, of the web request alone and end to end.
+The load test exits with an error, after printing the report, if every request
+of a command and size failed, and before measuring anything if the workers
+do not answer a first lookup.
+
+    DATABASE_URL=postgres://localhost/teamdict REDIS_URL=redis://localhost \\
+        python bench/loadtest.py --sizes 100,10000,100000 --requests 500
+
+Dictionaries are created for a team of their own and dropped afterwards.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import random
+import argparse
+import threading
+import subprocess
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEAM = 'loadtest'
+CHANNEL = 'CLOADTEST'
+
+class StubSlack(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Stands in for Slack. POSTs to /response/<id> are recorded as the reply
+    to request <id>, and calls to /api/<method> succeed.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.arrivals = {}
+        self.lock = threading.Lock()
+        self.arrived = threading.Condition(self.lock)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def record(self, request_id):
+        with self.arrived:
+            self.arrivals.setdefault(request_id, time.perf_counter())
+            self.arrived.notify_all()
+
+    def wait_for(self, request_ids, timeout):
+        """Wait until every request has a reply, or the timeout passes."""
+        deadline = time.monotonic() + timeout
+        with self.arrived:
+            while not all(i in self.arrivals for i in request_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.arrived.wait(remaining)
+            return {i: self.arrivals.get(i) for i in request_ids}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path.startswith('/response/'):
+            self.server.record(self.path[len('/response/'):])
+            body = b'ok'
+        else:
+            body = json.dumps({'ok': True,
+                               'message_ts': f'{time.time():.6f}'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def percentile(samples, pct):
+    if len(samples) == 0:
+        return float('nan')
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+class LoadTest:
+    def __init__(self, stub, concurrency, timeout):
+        from teamdict.wsgi import app
+        from teamdict.validate import compute_signature
+        self.app = app
+        self.compute_signature = compute_signature
+        self.stub = stub
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.next_id = 0
+        self.local = threading.local()
+
+    def form(self, command, text, request_id):
+        return {
+            'command': command,
+            'text': text,
+            'team_id': 'TLOADTEST',
+            'team_domain': TEAM,
+            'channel_id': CHANNEL,
+            'channel_name': 'loadtest',
+            'user_id': 'ULOADTEST',
+            'user_name': 'loadtest',
+            'response_url': f'{self.stub.url}response/{request_id}',
+        }
+
+    def signed_post(self, path, form):
+        """POST a form signed the way Slack signs requests."""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        body = urlencode(form)
+        timestamp = str(int(time.time()))
+        signature = self.compute_signature(timestamp, body.encode('utf-8'))
+        return client.post(path, data=body,
+                           content_type='application/x-www-form-urlencoded',
+                           headers={'X-Slack-Request-Timestamp': timestamp,
+                                    'X-Slack-Signature': signature})
+
+    def send(self, path, command, text):
+        """
+        Send one command and return its request id, when it was sent, how
+        long the route took, whether it was answered inline and its status.
+        """
+        with self.stub.lock:
+            request_id = str(self.next_id)
+            self.next_id += 1
+        form = self.form(command, text, request_id)
+        start = time.perf_counter()
+        response = self.signed_post(path, form)
+        end = time.perf_counter()
+        inline = len(response.get_data()) > 0
+        return request_id, start, end, inline, response.status_code
+
+    def run(self, path, command, texts):
+        """
+        Send every command with the configured concurrency and wait for the
+        replies.
+
+        Returns:
+            A dict of the results.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            sent = list(executor.map(
+                    lambda text: self.send(path, command, text), texts))
+
+        queued = [request_id for request_id, start, end, inline, status
+                  in sent if not inline and status == 200]
+        arrivals = self.stub.wait_for(queued, self.timeout)
+
+        web, end_to_end, finished = [], [], []
+        errors = 0
+        for request_id, start, end, inline, status in sent:
+            if status != 200:
+                errors += 1
+                continue
+            done = end if inline else arrivals.get(request_id)
+            web.append(end - start)
+            if done is None:
+                errors += 1
+                continue
+            end_to_end.append(done - start)
+            finished.append(done)
+
+        first = min(start for request_id, start, end, inline, status in sent)
+        elapsed = max(finished) - first if finished else float('nan')
+        return {
+            'requests': len(sent),
+            'inline': sum(1 for s in sent if s[3]),
+            'errors': errors,
+            'throughput': len(finished) / elapsed if finished else 0.0,
+            'web': web,
+            'end_to_end': end_to_end,
+        }
+
+def seed(size):
+    """Create a dictionary of 'size' keys for the load test."""
+    import teamdict.postgres as db
+    from teamdict.pool import connection
+    name = f'size{size}'
+    table_name = f'{TEAM}_{CHANNEL}_{name}'.lower()
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute('INSERT INTO dictionaries (team_domain, channel_id, name) '
+                    'VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;',
+                    db.split_table_name(table_name))
+        conn.commit()
+    db.invalidate_table_cache(table_name)
+    rows = ((f'key{i}', f'value of key {i}') for i in range(size))
+    db.bulk_add_data(table_name, rows)
+    return name
+
+def clean_up(names):
+    import teamdict.postgres as db
+    from teamdict import cache
+    from teamdict.pool import connection
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute('DELETE FROM dictionaries WHERE team_domain = %s;',
+                    (TEAM,))
+        conn.commit()
+    for name in names:
+        table_name = f'{TEAM}_{CHANNEL}_{name}'.lower()
+        db.invalidate_table_cache(table_name)
+        cache.invalidate_table_values(table_name)
+
+def start_workers(stub, workers):
+    env = dict(os.environ, SLACK_API_URL=f'{stub.url}api/', WORKERS=workers)
+    # A session of its own, so stopping it stops every worker it starts
+    return subprocess.Popen([sys.executable, 'worker.py'], cwd=ROOT, env=env,
+                            start_new_session=True)
+
+def stop_workers(workers):
+    os.killpg(workers.pid, signal.SIGTERM)
+    workers.wait()
+
+def report(rows):
+    print(f'{"command":12}{"size":>8}{"reqs":>6}{"inline":>7}{"errs":>5}'
+          f'{"req/s":>8}   web p50/p95/p99 ms     end to end p50/p95/p99 ms')
+    for command, size, result in rows:
+        web = [percentile(result['web'], p) * 1000 for p in (50, 95, 99)]
+        e2e = [percentile(result['end_to_end'], p) * 1000
+               for p in (50, 95, 99)]
+        print(f'{command:12}{size:>8}{result["requests"]:>6}'
+              f'{result["inline"]:>7}{result["errors"]:>5}'
+              f'{result["throughput"]:>8.1f}'
+              f'   {web[0]:6.1f} {web[1]:6.1f} {web[2]:6.1f}'
+              f'     {e2e[0]:7.1f} {e2e[1]:7.1f} {e2e[2]:7.1f}')
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Load test /lookup and /dbmod add end to end.')
+    parser.add_argument('--sizes', default='100,10000,100000',
+                        help='comma separated dictionary sizes')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per command and size')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', default='high=2,default=1,low=1',
+                        help='the WORKERS setting for the worker processes')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for replies after sending')
+    parser.add_argument('--cold', action='store_true',
+                        help='empty the lookup cache before each lookup run')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    stub = StubSlack()
+    stub.start()
+    # Settings the app and the workers read when they start
+    os.environ['SLACK_API_URL'] = f'{stub.url}api/'
+    os.environ.setdefault('SIGNING_SECRET', 'loadtest-signing-secret')
+    os.environ.setdefault('ACCESS_TOKEN', 'xoxb-loadtest')
+
+    from teamdict import cache
+    test = LoadTest(stub, args.concurrency, args.timeout)
+    names = []
+    workers = start_workers(stub, args.workers)
+    try:
+        for size in sizes:
+            print(f'Seeding a dictionary of {size} keys')
+            names.append(seed(size))
+        # Wait until the workers answer before measuring
+        warm_up = test.run('/slack/lookup', '/lookup', ['key0 ' + names[0]])
+        if warm_up['errors'] > 0:
+            sys.exit('FAIL the workers did not answer a first lookup within '
+                     f'{args.timeout:.0f}s, see their log above')
+
+        rows = []
+        for size, name in zip(sizes, names):
+            table_name = f'{TEAM}_{CHANNEL}_{name}'.lower()
+            if args.cold:
+                cache.invalidate_table_values(table_name)
+            texts = [f'key{random.randrange(size)} {name}'
+                     for i in range(args.requests)]
+            rows.append(('lookup', size,
+                         test.run('/slack/lookup', '/lookup', texts)))
+
+            run_id = random.randrange(10 ** 9)
+            texts = [f'add {name} new{run_id}x{i} value {i}'
+                     for i in range(args.requests)]
+            rows.append(('dbmod add', size,
+                         test.run('/slack/modify', '/dbmod', texts)))
+        report(rows)
+    finally:
+        stop_workers(workers)
+        clean_up(names)
+        stub.shutdown()
+
+    failed = [f'{command} at size {size}' for command, size, result in rows
+              if result['errors'] == result['requests']]
+    if failed:
+        sys.exit(f'FAIL every request errored for {", ".join(failed)}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
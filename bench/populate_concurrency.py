@@ -0,0 +1,117 @@
+"""
+populate_concurrency.py
+October 18, 2026
+
+Fires many /dbmod populate commands at once and checks that every data entry
+session they create keeps its own message timestamp. Needs the DATABASE_URL
+and REDIS_URL the app uses. Slack is replaced by a function returning a
+unique timestamp per message, so nothing is posted.
+
+    python bench/populate_concurrency.py --commands 200 --threads 32
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from teamdict import app, sessions
+from teamdict.pool import connection
+import teamdict.postgres as db
+
+TEAM = 'benchteam'
+CHANNEL = 'CBENCH'
+TABLE = 'populate'
+
+def fake_api_call(counter, lock):
+    """Build a stand-in for slack.api_call returning unique timestamps."""
+    def api_call(method, **kwargs):
+        with lock:
+            n = next(counter)
+        return {'ok': True, 'message_ts': f'{1500000000 + n}.000100'}
+    return api_call
+
+def populate_form(n):
+    return {
+        'text': f'populate {TABLE}',
+        'team_domain': TEAM,
+        'channel_id': CHANNEL,
+        'user_id': f'U{n:06d}',
+        'response_url': f'http://localhost/response/{n}',
+    }
+
+def run(commands, threads):
+    """
+    Run the populate commands and return the sessions they created along
+    with how long they took.
+    """
+    created = {}
+    created_lock = threading.Lock()
+    create_session = sessions.create_session
+
+    def record_session(ext, **fields):
+        create_session(ext, **fields)
+        with created_lock:
+            created[ext] = fields['message_ts']
+
+    db.api_call = fake_api_call(itertools.count(), threading.Lock())
+    db.sessions.create_session = record_session
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(
+                    lambda n: db.data_entry(populate_form(n),
+                                            'http://localhost/'),
+                    range(commands)))
+        elapsed = time.perf_counter() - start
+    finally:
+        db.sessions.create_session = create_session
+    return created, elapsed
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Check concurrent populate commands stay isolated.')
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute('INSERT INTO dictionaries (team_domain, channel_id, name) '
+                    'VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;',
+                    (TEAM, CHANNEL.lower(), TABLE))
+        conn.commit()
+    db.invalidate_table_cache(f'{TEAM}_{CHANNEL}_{TABLE}')
+
+    try:
+        created, elapsed = run(args.commands, args.threads)
+    finally:
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute('DELETE FROM dictionaries WHERE team_domain = %s;',
+                        (TEAM,))
+            conn.commit()
+        db.invalidate_table_cache(f'{TEAM}_{CHANNEL}_{TABLE}')
+
+    failures = []
+    if len(created) != args.commands:
+        failures.append(f'{len(created)} sessions for {args.commands} '
+                        f'commands')
+    for ext, message_ts in created.items():
+        session = sessions.pop_session(ext)
+        if session.get('message_ts') != message_ts:
+            failures.append(f'{ext}: message_ts {session.get("message_ts")} '
+                            f'expected {message_ts}')
+
+    print(f'{args.commands} populate commands on {args.threads} threads '
+          f'in {elapsed:.2f}s ({args.commands / elapsed:.0f}/s)')
+    for failure in failures[:20]:
+        print(f'FAIL {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK every session kept its own message_ts')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,70 @@
+"""
+worker_throughput.py
+October 18, 2026
+
+Compares the jobs per second of the forking worker with the threaded worker
+started when WORKER_THREADS is set. Each job waits on I/O the way ours do:
+by default a trivial query through the app's connection pool and a sleep
+standing in for the Slack POST. Needs the DATABASE_URL and REDIS_URL the app
+uses; jobs go to a queue of their own.
+
+    python bench/worker_throughput.py --jobs 500 --threads 16
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis
+from rq import Queue, Connection
+from worker import MeteredWorker, ThreadedWorker, redis_url
+
+QUEUE = 'bench_worker_throughput'
+
+def io_job(post_ms, query):
+    """A job shaped like ours: a database round trip, then a Slack POST."""
+    if query:
+        from teamdict.pool import connection
+        with connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT 1;')
+    time.sleep(post_ms / 1000)
+
+def run(make_worker, jobs, post_ms, query):
+    """Queue the jobs, work them off in burst mode and return jobs/sec."""
+    queue = Queue(QUEUE)
+    queue.empty()
+    for i in range(jobs):
+        queue.enqueue(io_job, post_ms, query)
+
+    start = time.perf_counter()
+    make_worker([queue]).work(burst=True, logging_level='WARNING')
+    elapsed = time.perf_counter() - start
+    return jobs / elapsed
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Compare forking and threaded worker throughput.')
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--post-ms', type=float, default=5,
+                        help='simulated Slack POST latency')
+    parser.add_argument('--no-query', dest='query', action='store_false',
+                        help='skip the database round trip')
+    args = parser.parse_args(argv)
+
+    with Connection(redis.from_url(redis_url)):
+        forking = run(MeteredWorker, args.jobs, args.post_ms, args.query)
+        threaded = run(lambda queues: ThreadedWorker(queues,
+                                                     threads=args.threads),
+                       args.jobs, args.post_ms, args.query)
+
+    print(f'{args.jobs} jobs, {args.post_ms}ms simulated POST, '
+          f'query={args.query}')
+    print(f'forking worker:             {forking:8.1f} jobs/s')
+    print(f'threaded worker ({args.threads:2d} threads): {threaded:8.1f} jobs/s')
+    print(f'speedup: {threaded / forking:.1f}x')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,231 @@
+"""
+migrate.py
+October 18, 2026
+
+Sets up the app's tables and moves the dictionaries stored in the old
+layout, one physical table named <team_domain>_<channel_id>_<table_name> per
+dictionary, into the shared dictionaries and entries tables. The release
+step of every deploy only runs the schema setup; the move is run by hand,
+once.
+
+    python migrate.py --schema-only
+        Only create any missing tables and indexes. This is the release
+        step.
+
+    python migrate.py
+        Create any missing tables and indexes, then copy every legacy table
+        not copied before in small batches. Each table copied is recorded in
+        the legacy_migrations table and skipped by later runs, so running
+        this again never brings back dictionaries or keys deleted through
+        the new release.
+
+    python migrate.py --catch-up
+        Also copy rows modified in tables already copied since they were
+        copied, for writes made by the old release. Only run this before the
+        new release starts serving. Dictionaries no longer registered are
+        never recreated.
+
+    python migrate.py --drop
+        Once the new release is deployed, drop each legacy table, copying
+        it first if it has not been copied yet, and the data_entry_queue
+        table the old release kept data entry sessions in. Sessions are now
+        kept in Redis by teamdict.sessions.
+
+Keys deleted from a legacy table after it was first copied are not removed
+from the entries table.
+"""
+import sys
+import argparse
+from teamdict import app, cache
+from teamdict.pool import connection
+from teamdict.schema import create_schema
+from teamdict.postgres import split_table_name, invalidate_table_cache, as_is
+
+def find_legacy_tables(conn):
+    """
+    Find the tables in the old per-dictionary layout, recognized by having
+    exactly the key, value and date_modified columns.
+
+    Args:
+        conn (connection): The database connection to use.
+
+    Returns:
+        A list of long form table names.
+    """
+    with conn.cursor() as cur:
+        query = ('SELECT table_name FROM information_schema.columns ' +
+                "WHERE table_schema = 'public' " +
+                'GROUP BY table_name ' +
+                'HAVING array_agg(column_name::text ORDER BY column_name) = ' +
+                "ARRAY['date_modified', 'key', 'value'];")
+        cur.execute(query)
+        return sorted(row[0] for row in cur.fetchall())
+
+def create_marker_table(conn):
+    """Create the table recording which legacy tables have been copied."""
+    with conn.cursor() as cur:
+        query = ('CREATE TABLE IF NOT EXISTS legacy_migrations (' +
+                'table_name VARCHAR PRIMARY KEY, ' +
+                'copied_at TIMESTAMPTZ NOT NULL DEFAULT now()' +
+                ');')
+        cur.execute(query)
+    conn.commit()
+
+def copied_tables(conn):
+    """Return the set of legacy tables that have been copied."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT table_name FROM legacy_migrations;')
+        return set(row[0] for row in cur.fetchall())
+
+def is_registered(cur, table_name):
+    """Check that a dictionary is still registered."""
+    query = ('SELECT 1 FROM dictionaries ' +
+            'WHERE team_domain = %s AND channel_id = %s AND name = %s;')
+    cur.execute(query, split_table_name(table_name))
+    return cur.fetchone() is not None
+
+def drop_data_entry_queue(conn):
+    """
+    Drop the table the old release kept data entry sessions in, ending any
+    session it still holds.
+
+    Returns:
+        True if the table existed.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('data_entry_queue') IS NOT NULL;")
+        exists = cur.fetchone()[0]
+        cur.execute('DROP TABLE IF EXISTS data_entry_queue;')
+    conn.commit()
+    return exists
+
+def copy_batch(cur, table_name, after_key, batch_size):
+    """
+    Copy up to batch_size rows with keys after after_key from a legacy table
+    into the entries table.
+
+    Args:
+        cur (cursor): The cursor to execute the copy with.
+        table_name (str): The long form name of the legacy table.
+        after_key (str): Copy rows with keys greater than this, None to start
+            from the first key.
+        batch_size (int): The most rows to copy, None for every row.
+
+    Returns:
+        A tuple of the last key read, rows read and rows written.
+    """
+    query = ('WITH batch AS (' +
+                'SELECT key, value, date_modified FROM %s ' +
+                'WHERE %s IS NULL OR key > %s ' +
+                'ORDER BY key LIMIT %s' +
+            '), moved AS (' +
+                'INSERT INTO entries (team_domain, channel_id, dictionary, ' +
+                'key, value, date_modified) ' +
+                'SELECT %s, %s, %s, key, value, date_modified FROM batch ' +
+                'ON CONFLICT (team_domain, channel_id, dictionary, key) ' +
+                'DO UPDATE SET value = EXCLUDED.value, ' +
+                'date_modified = EXCLUDED.date_modified ' +
+                'WHERE entries.date_modified < EXCLUDED.date_modified ' +
+                'RETURNING 1' +
+            ') ' +
+            'SELECT max(key), count(*), (SELECT count(*) FROM moved) ' +
+            'FROM batch;')
+    params = (as_is(table_name), after_key, after_key, batch_size) + \
+             split_table_name(table_name)
+    cur.execute(query, params)
+    return cur.fetchone()
+
+def migrate_table(conn, table_name, batch_size, copied=False, drop=False):
+    """
+    Register a legacy table as a dictionary and copy its rows across, one
+    transaction per batch so no lock is held for long, then record it as
+    copied and forget the table's cached lookups. A table copied before only
+    has rows modified since copied, and only while its dictionary is still
+    registered.
+
+    Args:
+        conn (connection): The database connection to use.
+        table_name (str): The long form name of the legacy table.
+        batch_size (int): Rows copied per transaction.
+        copied (bool): (Optional) Whether the table has been copied before.
+        drop (bool): (Optional) Drop the legacy table once it is copied.
+
+    Returns:
+        The number of rows written to the entries table.
+    """
+    written = 0
+    with conn.cursor() as cur:
+        if not copied:
+            query = ('INSERT INTO dictionaries ' +
+                    '(team_domain, channel_id, name) ' +
+                    'VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;')
+            cur.execute(query, split_table_name(table_name))
+            conn.commit()
+
+        if is_registered(cur, table_name):
+            after_key = None
+            while True:
+                last_key, read, moved = copy_batch(cur, table_name, after_key,
+                                                   batch_size)
+                conn.commit()
+                written += moved
+                if read < batch_size:
+                    break
+                after_key = last_key
+
+        query = ('INSERT INTO legacy_migrations (table_name) VALUES (%s) ' +
+                'ON CONFLICT DO NOTHING;')
+        cur.execute(query, (table_name,))
+        if drop:
+            cur.execute('DROP TABLE %s;', (as_is(table_name),))
+        conn.commit()
+
+    # Lookups answered before the copy may have cached its keys as not found
+    invalidate_table_cache(table_name)
+    cache.invalidate_table_values(table_name)
+    return written
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Move legacy per-dictionary tables into entries.')
+    parser.add_argument('--drop', action='store_true',
+                        help='drop each legacy table after copying it, and '
+                             'data_entry_queue')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows copied per transaction')
+    parser.add_argument('--schema-only', action='store_true',
+                        help='only create missing tables and indexes')
+    parser.add_argument('--catch-up', action='store_true',
+                        help='copy changes to tables copied before, only '
+                             'while the old release is serving')
+    args = parser.parse_args(argv)
+
+    with connection() as conn:
+        create_schema(conn, app.config['ENTRIES_PARTITIONS'])
+        print('Schema up to date')
+        if args.schema_only:
+            return
+
+        create_marker_table(conn)
+        copied = copied_tables(conn)
+        tables = find_legacy_tables(conn)
+        print(f'{len(tables)} legacy tables found')
+        for table_name in tables:
+            if table_name in copied and not args.catch_up:
+                if args.drop:
+                    with conn.cursor() as cur:
+                        cur.execute('DROP TABLE %s;', (as_is(table_name),))
+                    conn.commit()
+                    print(f'{table_name}: dropped')
+                continue
+            written = migrate_table(conn, table_name, args.batch_size,
+                                    copied=table_name in copied,
+                                    drop=args.drop)
+            dropped = ' and dropped' if args.drop else ''
+            print(f'{table_name}: {written} rows copied{dropped}')
+
+        if args.drop and drop_data_entry_queue(conn):
+            print('data_entry_queue: dropped')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,5 @@
 import os
-from teamdict import app
+from teamdict.wsgi import app
 #from flask import session
 
 if __name__ == '__main__':
@@ -3,10 +3,8 @@ import rq
 import sys
 import logging
 import redis
-import psycopg2
 from pkg_resources import get_provider
 from flask import Flask
-from worker import conn
 
 # Set module name
 __module__ = 'teamdict'
@@ -29,28 +27,43 @@ def set_app_config():
         'ACCESS_TOKEN': os.environ.get('ACCESS_TOKEN'),
         'ALLOWED_EXTENSIONS': set(['txt', 'csv']),
         'UPLOAD_FOLDER': provider.module_path + upload_folder,
+        'DB_POOL_MIN': int(os.environ.get('DB_POOL_MIN', 1)),
+        'DB_POOL_MAX': int(os.environ.get('DB_POOL_MAX', 10)),
+        'DB_POOL_TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        'DB_POOL_CHECK_AFTER': float(os.environ.get('DB_POOL_CHECK_AFTER', 30)),
+        'ENTRIES_PARTITIONS': int(os.environ.get('ENTRIES_PARTITIONS', 0)),
+        'SCHEMA_CACHE_TTL': int(os.environ.get('SCHEMA_CACHE_TTL', 3600)),
+        'LOOKUP_CACHE_TTL': int(os.environ.get('LOOKUP_CACHE_TTL', 3600)),
+        'LOOKUP_CACHE_MAX_KEYS': int(os.environ.get('LOOKUP_CACHE_MAX_KEYS',
+                                                    100000)),
+        'SEARCH_LIMIT': int(os.environ.get('SEARCH_LIMIT', 10)),
+        'SLACK_API_URL': os.environ.get('SLACK_API_URL',
+                                        'https://slack.com/api/'),
+        'SLACK_POOL_SIZE': int(os.environ.get('SLACK_POOL_SIZE', 10)),
+        'SLACK_TIMEOUT': float(os.environ.get('SLACK_TIMEOUT', 10)),
+        'SLACK_SEND_QUEUE': os.environ.get('SLACK_SEND_QUEUE', '') == '1',
+        'SLACK_FLUSH_TIMEOUT': float(os.environ.get('SLACK_FLUSH_TIMEOUT', 30)),
+        'UPLOAD_STREAM_INGEST': os.environ.get('UPLOAD_STREAM_INGEST', '') == '1',
+        'INGEST_CHUNK_SIZE': int(os.environ.get('INGEST_CHUNK_SIZE', 5000)),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+        'SLACK_SIGNATURE_MAX_AGE': int(os.environ.get('SLACK_SIGNATURE_MAX_AGE',
+                                                      300)),
+        'EXPORT_LINK_TTL': int(os.environ.get('EXPORT_LINK_TTL', 600)),
+        'DATA_ENTRY_TTL': int(os.environ.get('DATA_ENTRY_TTL', 120)),
+        'UPLOAD_ORPHAN_AGE': int(os.environ.get('UPLOAD_ORPHAN_AGE', 3600)),
+        'UPLOAD_SWEEP_INTERVAL': int(os.environ.get('UPLOAD_SWEEP_INTERVAL',
+                                                    600)),
     }
 
-# Initialize flask app
+# Initialize flask app. Nothing connects to Redis or PostgreSQL here: redis
+# clients connect on their first command and the database pool is created
+# by teamdict.pool on first use. The schema is set up by migrate.py, and the
+# routes are registered by teamdict.wsgi, so workers do not load them.
 app = Flask(__name__)
 app.config.update(set_app_config())
-app.task_queue = rq.Queue(connection=conn)
+app.redis = redis.from_url(app.config['REDIS_URL'])
+# Interactive jobs go to 'high', changes to 'default' and bulk loads to 'low'
+app.queues = {name: rq.Queue(name, connection=app.redis)
+              for name in ('high', 'default', 'low')}
+app.task_queue = app.queues['default']
 app.logger.addHandler(logging.StreamHandler(sys.stdout))
-app.dbconn = psycopg2.connect(app.config['DATABASE_URL'], sslmode='require')
-
-# Set up database table for mass data entry
-with app.dbconn.cursor() as cur:
-    query = ('CREATE TABLE IF NOT EXISTS data_entry_queue (' +
-            'url_ext VARCHAR PRIMARY KEY, ' +
-            'table_name VARCHAR, ' +
-            'response_url VARCHAR, ' +
-            'user_id VARCHAR, ' +
-            'channel_id VARCHAR, ' +
-            'message_ts NUMERIC(16, 6), ' +
-            "exp_date TIMESTAMP NOT NULL DEFAULT now() + interval '2 minutes'" +
-            ');')
-    cur.execute(query)
-    app.dbconn.commit()
-
-# Allow app to find @app.route views
-from teamdict import views
@@ -0,0 +1,321 @@
+"""
+cache.py
+October 18, 2026
+
+This module caches data in Redis so the common commands do not have to query
+PostgreSQL. Two caches are kept, both shared by every web and worker process:
+
+    - The list of tables in each channel, invalidated by the functions that
+      create and drop tables.
+    - The value of each (table, key) looked up, including keys that were not
+      found. Entries expire after LOOKUP_CACHE_TTL seconds and the least
+      recently used are evicted once there are more than
+      LOOKUP_CACHE_MAX_KEYS. The functions that change a table's data
+      invalidate exactly the keys they changed.
+
+Each invalidation also bumps a version key: the channel's for its table list,
+the table's for its values. Readers fetch the version before querying the
+database and only cache what they read if it has not changed since, so a
+result read before a concurrent change commits cannot be cached after the
+change invalidated it.
+
+Redis errors are treated as cache misses.
+"""
+import json
+import time
+import redis
+from teamdict import app, metrics
+
+TABLES_PREFIX = 'teamdict:tables:'
+TABLES_VERSION_PREFIX = 'teamdict:tables_version:'
+VALUE_PREFIX = 'teamdict:value:'
+VALUE_INDEX_PREFIX = 'teamdict:value_index:'
+VALUE_LRU = 'teamdict:value_lru'
+VALUE_VERSION_PREFIX = 'teamdict:value_version:'
+
+def channel_prefix(team_domain, channel_id):
+    """
+    Build the prefix shared by the long form names of every table in a
+    channel, <team_domain>_<channel_id>.
+    """
+    return f'{team_domain}_{channel_id}'.lower()
+
+def get_channel_tables(prefix):
+    """
+    Fetch the cached list of tables in a channel.
+
+    Args:
+        prefix (str): The channel's prefix from channel_prefix().
+
+    Returns:
+        A list of long form table names, or None if the channel is not cached.
+    """
+    try:
+        cached = app.redis.get(TABLES_PREFIX + prefix)
+    except redis.RedisError as e:
+        app.logger.warning(f'Schema cache unavailable: {e}')
+        return None
+
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+def channel_tables_version(prefix):
+    """
+    Fetch the version of a channel's table list, to be passed to
+    set_channel_tables() once the list has been read from the database.
+
+    Args:
+        prefix (str): The channel's prefix from channel_prefix().
+
+    Returns:
+        The current version, None if the list has never been invalidated.
+    """
+    try:
+        return app.redis.get(TABLES_VERSION_PREFIX + prefix)
+    except redis.RedisError as e:
+        app.logger.warning(f'Schema cache unavailable: {e}')
+        return None
+
+def set_channel_tables(prefix, table_names, version):
+    """
+    Cache the list of tables in a channel, unless the list was invalidated
+    after version was fetched.
+
+    Args:
+        prefix (str): The channel's prefix from channel_prefix().
+        table_names (list): The long form names of the channel's tables.
+        version (bytes): The version from channel_tables_version(), fetched
+            before table_names was read.
+
+    Returns:
+        None
+    """
+    version_key = TABLES_VERSION_PREFIX + prefix
+    try:
+        with app.redis.pipeline() as pipe:
+            pipe.watch(version_key)
+            if pipe.get(version_key) != version:
+                return
+            pipe.multi()
+            pipe.set(TABLES_PREFIX + prefix, json.dumps(table_names),
+                     ex=app.config['SCHEMA_CACHE_TTL'])
+            pipe.execute()
+    except redis.WatchError:
+        pass
+    except redis.RedisError as e:
+        app.logger.warning(f'Schema cache unavailable: {e}')
+
+def invalidate_channel_tables(prefix):
+    """
+    Forget the cached list of tables in a channel. Must be called after any
+    change to the channel's tables has been committed.
+
+    Args:
+        prefix (str): The channel's prefix from channel_prefix().
+
+    Returns:
+        None
+    """
+    version_key = TABLES_VERSION_PREFIX + prefix
+    try:
+        pipe = app.redis.pipeline()
+        pipe.incr(version_key)
+        pipe.expire(version_key, app.config['SCHEMA_CACHE_TTL'] * 2)
+        pipe.delete(TABLES_PREFIX + prefix)
+        pipe.execute()
+    except redis.RedisError as e:
+        app.logger.warning(f'Schema cache unavailable: {e}')
+
+def value_key(table_name, key):
+    """Build the Redis key caching the value of key in a table."""
+    return VALUE_PREFIX + json.dumps([table_name.lower(), key])
+
+@metrics.staged('cache')
+def get_values(pairs, partial=True):
+    """
+    Fetch the cached values of keys, with a single Redis round trip however
+    many tables they belong to.
+
+    Args:
+        pairs (list): (table_name, key) tuples to fetch, table names in long
+            form.
+        partial (bool): (Optional) Whether the values found are wanted when
+            some pairs are not cached. If not, nothing is returned or counted
+            as a hit or miss unless every pair is cached, so a lookup tried
+            inline and then queued is only counted by the queued job.
+
+    Returns:
+        A dict of (table_name, key) to value for every pair found in the
+        cache. The value is None for keys cached as not being in the table.
+    """
+    if len(pairs) == 0:
+        return {}
+
+    cache_keys = [value_key(table_name, key) for table_name, key in pairs]
+    try:
+        cached = app.redis.mget(cache_keys)
+        if not partial and None in cached:
+            return {}
+        hits = {}
+        touched = {}
+        for pair, cache_key, value in zip(pairs, cache_keys, cached):
+            if value is not None:
+                hits[pair] = json.loads(value)
+                touched[cache_key] = time.time()
+        if len(touched) > 0:
+            app.redis.zadd(VALUE_LRU, **touched)
+    except redis.RedisError as e:
+        app.logger.warning(f'Lookup cache unavailable: {e}')
+        if not partial:
+            return {}
+        hits = {}
+
+    if len(hits) > 0:
+        metrics.incr('lookup_cache.hit', len(hits))
+    if len(pairs) > len(hits):
+        metrics.incr('lookup_cache.miss', len(pairs) - len(hits))
+    return hits
+
+def value_versions(table_names):
+    """
+    Fetch the versions of the cached values of tables, to be passed to
+    set_values() once the values have been read from the database.
+
+    Args:
+        table_names (list): The long form names of the tables.
+
+    Returns:
+        A dict of lowercased table name to its current version, None for
+        tables whose values have never been invalidated.
+    """
+    names = list(dict.fromkeys(name.lower() for name in table_names))
+    if len(names) == 0:
+        return {}
+    try:
+        versions = app.redis.mget([VALUE_VERSION_PREFIX + name
+                                   for name in names])
+    except redis.RedisError as e:
+        app.logger.warning(f'Lookup cache unavailable: {e}')
+        versions = [None] * len(names)
+    return dict(zip(names, versions))
+
+@metrics.staged('cache')
+def set_values(values, versions):
+    """
+    Cache the values of keys, evicting the least recently used values if the
+    cache has grown past LOOKUP_CACHE_MAX_KEYS. Values of tables invalidated
+    after versions was fetched are not cached.
+
+    Args:
+        values (dict): (table_name, key) to value, None for keys not in the
+            table. Table names are in long form.
+        versions (dict): The versions from value_versions(), fetched before
+            values was read.
+
+    Returns:
+        None
+    """
+    if len(values) == 0:
+        return
+
+    ttl = app.config['LOOKUP_CACHE_TTL']
+    now = time.time()
+    touched = {}
+    indexes = {}
+    names = list(versions)
+    version_keys = [VALUE_VERSION_PREFIX + name for name in names]
+    try:
+        with app.redis.pipeline() as pipe:
+            pipe.watch(*version_keys)
+            current = dict(zip(names, pipe.mget(version_keys)))
+            pipe.multi()
+            for (table_name, key), value in values.items():
+                name = table_name.lower()
+                if name not in current or current[name] != versions[name]:
+                    continue
+                cache_key = value_key(table_name, key)
+                pipe.set(cache_key, json.dumps(value), ex=ttl)
+                touched[cache_key] = now
+                indexes.setdefault(VALUE_INDEX_PREFIX + name,
+                                   []).append(cache_key)
+            if len(touched) == 0:
+                return
+            for index_key, cache_keys in indexes.items():
+                pipe.sadd(index_key, *cache_keys)
+                pipe.expire(index_key, ttl)
+            pipe.zadd(VALUE_LRU, **touched)
+            pipe.zcard(VALUE_LRU)
+            size = pipe.execute()[-1]
+
+        overflow = size - app.config['LOOKUP_CACHE_MAX_KEYS']
+        if overflow > 0:
+            evict(app.redis.zrange(VALUE_LRU, 0, overflow - 1))
+    except redis.WatchError:
+        pass
+    except redis.RedisError as e:
+        app.logger.warning(f'Lookup cache unavailable: {e}')
+
+def evict(cache_keys):
+    """Remove cached values, given their Redis keys, from the cache."""
+    if len(cache_keys) == 0:
+        return
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.delete(*cache_keys)
+    pipe.zrem(VALUE_LRU, *cache_keys)
+    pipe.execute()
+    metrics.incr('lookup_cache.evictions', len(cache_keys))
+
+def invalidate_values(table_name, keys):
+    """
+    Forget the cached values of keys in a table. Must be called after the
+    change to those keys has been committed.
+
+    Args:
+        table_name (str): The long form name of the table.
+        keys (iterable): The keys whose values changed.
+
+    Returns:
+        None
+    """
+    cache_keys = [value_key(table_name, key) for key in keys]
+    if len(cache_keys) == 0:
+        return
+
+    version_key = VALUE_VERSION_PREFIX + table_name.lower()
+    try:
+        pipe = app.redis.pipeline(transaction=False)
+        pipe.incr(version_key)
+        pipe.expire(version_key, app.config['LOOKUP_CACHE_TTL'] * 2)
+        pipe.delete(*cache_keys)
+        pipe.srem(VALUE_INDEX_PREFIX + table_name.lower(), *cache_keys)
+        pipe.zrem(VALUE_LRU, *cache_keys)
+        pipe.execute()
+    except redis.RedisError as e:
+        app.logger.warning(f'Lookup cache unavailable: {e}')
+
+def invalidate_table_values(table_name):
+    """
+    Forget every cached value of a table. Must be called after the table's
+    data has been changed or dropped.
+
+    Args:
+        table_name (str): The long form name of the table.
+
+    Returns:
+        None
+    """
+    index_key = VALUE_INDEX_PREFIX + table_name.lower()
+    version_key = VALUE_VERSION_PREFIX + table_name.lower()
+    try:
+        app.redis.incr(version_key)
+        app.redis.expire(version_key, app.config['LOOKUP_CACHE_TTL'] * 2)
+        cache_keys = list(app.redis.smembers(index_key))
+        pipe = app.redis.pipeline(transaction=False)
+        if len(cache_keys) > 0:
+            pipe.delete(*cache_keys)
+            pipe.zrem(VALUE_LRU, *cache_keys)
+        pipe.delete(index_key)
+        pipe.execute()
+    except redis.RedisError as e:
+        app.logger.warning(f'Lookup cache unavailable: {e}')
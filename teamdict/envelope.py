@@ -0,0 +1,113 @@
+"""
+envelope.py
+October 18, 2026
+
+This module packs the data a queued job needs from a Slack request into a
+small versioned JSON envelope,
+
+    {"v": 1, "t": <job_type>, "u": <url_root>, "f": {<form fields>},
+     "i": <trace_id>, "c": <command>, "s": <time queued>}
+
+Only the form fields the handlers read are kept. Headers and the raw body
+are dropped, since requests are verified before they are queued. The trace
+id, command and time queued let the worker continue the request's trace in
+teamdict.metrics. Nothing here imports the app, so a job can be decoded
+without it.
+"""
+import json
+import time
+from collections import namedtuple
+
+VERSION = 1
+
+# The fields of a slash command the handlers read
+COMMAND_FIELDS = ('command', 'text', 'response_url', 'team_domain',
+                  'channel_id', 'channel_name', 'user_id')
+
+# The fields of an interactive message payload the handlers read
+RESPONSE_FIELDS = ('actions', 'callback_id', 'channel', 'message_ts',
+                   'response_url', 'team', 'user')
+
+# The names command_name() gives commands, subcommands of /dbmod and the
+# values of message buttons. Anything else is named 'other', so requests
+# cannot create metrics of their own
+COMMANDS = ('lookup', 'dbmod')
+DBMOD_COMMANDS = ('help', 'create', 'drop', 'add', 'set', 'populate',
+                  'delete', 'export')
+ACTIONS = ('cancel', 'done', 'drop', 'delete', 'url_button')
+
+JobData = namedtuple('JobData', ['job_type', 'form', 'url', 'trace_id',
+                                 'command', 'sent_at'])
+
+def command_name(job_type, form):
+    """
+    Name the command a request carries for metrics, e.g. 'lookup',
+    'dbmod.add' or 'response.drop'. Commands, subcommands and button values
+    that are not known are named 'other'.
+    """
+    if job_type == 'response':
+        actions = form.get('actions')
+        action = actions[0] if isinstance(actions, list) and actions else {}
+        value = action.get('value') if isinstance(action, dict) else None
+        return f'response.{value if value in ACTIONS else "other"}'
+
+    command = str(form.get('command', '')).lstrip('/')
+    if command not in COMMANDS:
+        return 'other'
+    words = str(form.get('text', '')).lower().split()
+    if command == 'dbmod' and len(words) > 0:
+        subcommand = words[0] if words[0] in DBMOD_COMMANDS else 'other'
+        return f'{command}.{subcommand}'
+    return command
+
+def pack(job_type, form, url='', trace_id=None, command=None):
+    """
+    Build the envelope for a job.
+
+    Args:
+        job_type (str): Describes what functions the command has access to.
+        form (dict): The slash command's form, or the interactive message's
+            decoded payload for 'response' jobs.
+        url (str): (Optional) The root url of the app, for data entry links.
+        trace_id (str): (Optional) The id of the request's trace.
+        command (str): (Optional) The command's name from command_name().
+
+    Returns:
+        The envelope as a str.
+    """
+    fields = RESPONSE_FIELDS if job_type == 'response' else COMMAND_FIELDS
+    envelope = {
+        'v': VERSION,
+        't': job_type,
+        'f': {field: form[field] for field in fields if field in form},
+        's': round(time.time(), 6),
+    }
+    if url:
+        envelope['u'] = url
+    if trace_id:
+        envelope['i'] = trace_id
+    if command:
+        envelope['c'] = command
+    return json.dumps(envelope, separators=(',', ':'))
+
+def unpack(payload):
+    """
+    Decode an envelope built by pack().
+
+    Args:
+        payload (str): The envelope.
+
+    Returns:
+        A JobData tuple of the job_type, form, url, trace_id, command and
+        the time the job was queued, sent_at.
+
+    Raises:
+        ValueError if the envelope is not a version this module can read.
+    """
+    envelope = json.loads(payload)
+    if envelope.get('v') != VERSION:
+        raise ValueError(f'Unsupported job envelope version: {envelope.get("v")}')
+    job_type, form = envelope['t'], envelope['f']
+    return JobData(job_type, form, envelope.get('u', ''), envelope.get('i'),
+                   envelope.get('c') or command_name(job_type, form),
+                   envelope.get('s'))
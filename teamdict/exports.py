@@ -0,0 +1,150 @@
+"""
+exports.py
+October 18, 2026
+
+This module serves dictionary exports. /dbmod export creates a link to
+/export/<token>, where the token is kept in Redis for EXPORT_LINK_TTL
+seconds,
+
+    teamdict:export:<token>
+
+The route streams the dictionary straight out of PostgreSQL with COPY TO
+STDOUT. COPY runs on a thread of its own and hands its output over through a
+bounded queue, so the response starts as soon as the first rows arrive and
+memory use stays flat however large the dictionary is.
+"""
+import json
+import queue
+import secrets
+import threading
+from teamdict import app
+from teamdict.pool import connection
+
+EXPORT_PREFIX = 'teamdict:export:'
+
+# The media type and file extension of each format
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'json': ('application/x-ndjson', 'ndjson'),
+}
+
+# Queued pieces of COPY output, about 8KB each
+QUEUE_SIZE = 32
+_DONE = object()
+
+def create_link(table_name, fmt):
+    """
+    Create a token for downloading a dictionary.
+
+    Args:
+        table_name (str): The long form name of the table.
+        fmt (str): 'csv' or 'json'.
+
+    Returns:
+        The token.
+    """
+    token = secrets.token_urlsafe(24)
+    app.redis.set(EXPORT_PREFIX + token,
+                  json.dumps({'table_name': table_name, 'format': fmt}),
+                  ex=app.config['EXPORT_LINK_TTL'])
+    return token
+
+def get_link(token):
+    """
+    Look up an export token.
+
+    Returns:
+        A dict with the 'table_name' and 'format', empty if the token does
+        not exist or has expired.
+    """
+    link = app.redis.get(EXPORT_PREFIX + token)
+    if link is None:
+        return {}
+    return json.loads(link)
+
+def copy_query(cur, table_name, fmt):
+    """
+    Build the COPY statement exporting a dictionary, ordered by key.
+
+    CSV has a header row. JSON is one {"key": ..., "value": ...} object per
+    line; it is copied as CSV with a quote and delimiter JSON never contains
+    unescaped, so the objects are written out exactly as built.
+    """
+    # Imported here as teamdict.postgres creates export links
+    from teamdict.postgres import split_table_name
+    select = cur.mogrify(
+            'SELECT key, value FROM entries ' +
+            'WHERE team_domain = %s AND channel_id = %s AND dictionary = %s ' +
+            'ORDER BY key', split_table_name(table_name)).decode('utf-8')
+
+    if fmt == 'json':
+        return ("COPY (SELECT json_build_object('key', key, " +
+                f'\'value\', value) FROM ({select}) AS export) ' +
+                "TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', " +
+                "DELIMITER E'\\x02');")
+    return f'COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER);'
+
+class QueueWriter:
+    """
+    File-like object handing what COPY writes to the streaming response.
+    Writes block while the queue is full, and fail once the response has
+    been closed so COPY stops.
+    """
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.closed = threading.Event()
+
+    def write(self, data):
+        while True:
+            if self.closed.is_set():
+                raise IOError('Export download closed')
+            try:
+                self.queue.put(data, timeout=1)
+                return len(data)
+            except queue.Full:
+                continue
+
+def stream_table(table_name, fmt):
+    """
+    Stream a dictionary out of the database.
+
+    Args:
+        table_name (str): The long form name of the table.
+        fmt (str): 'csv' or 'json'.
+
+    Yields:
+        bytes of the export as COPY produces them.
+    """
+    writer = QueueWriter()
+    failure = []
+
+    def copy():
+        try:
+            with connection() as conn, conn.cursor() as cur:
+                cur.copy_expert(copy_query(cur, table_name, fmt), writer)
+                conn.rollback()
+        except Exception as e:
+            if not writer.closed.is_set():
+                app.logger.error(f'Export of {table_name} failed: {e}')
+                failure.append(e)
+        finally:
+            writer.queue.put(_DONE)
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            data = writer.queue.get()
+            if data is _DONE:
+                break
+            yield data if isinstance(data, bytes) else data.encode('utf-8')
+        if failure:
+            raise failure[0]
+    finally:
+        # Stop COPY if the download ended early, then let it clean up
+        writer.closed.set()
+        while thread.is_alive():
+            try:
+                writer.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
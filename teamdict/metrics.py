@@ -0,0 +1,258 @@
+"""
+metrics.py
+October 18, 2026
+
+This module records counters and timing samples for the app. Everything is
+kept in Redis so the numbers recorded by web and worker processes can be read
+together through the /metrics endpoint, which is only served when
+METRICS_TOKEN is set and to requests sending it. Recording a metric never
+raises; if Redis is unavailable the sample is dropped and logged.
+
+A Slack request can be traced from the web process through the queue to the
+worker. Each process opens a trace() for its part of the request, tagged
+with the request's trace id and command, and the time spent in each stage()
+is added to it. Stages exclude the time spent in stages nested inside them,
+so they add up to no more than the trace's total. The worker adds the time
+the job spent queued as its 'queue' stage, which comes before its total
+starts. When a trace finishes its
+stages are recorded as 'command.<command>.<stage>' timings and logged as a
+single JSON line.
+"""
+import sys
+import json
+import time
+import uuid
+import redis
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from teamdict import app
+
+COUNTERS_KEY = 'teamdict:metrics:counters'
+TIMINGS_KEY = 'teamdict:metrics:timings'
+SAMPLES_PREFIX = 'teamdict:metrics:samples:'
+MAX_SAMPLES = 1000
+
+# The trace open on the current thread, if any
+_local = threading.local()
+
+# Finished traces are logged one JSON object per line
+trace_log = logging.getLogger('teamdict.trace')
+trace_log.setLevel(logging.INFO)
+trace_log.addHandler(logging.StreamHandler(sys.stdout))
+trace_log.propagate = False
+
+def incr(name, amount=1):
+    """
+    Increment a named counter.
+
+    Args:
+        name (str): The name of the counter, e.g. 'db_pool.timeouts'.
+        amount (int): (Optional) The amount to add to the counter.
+
+    Returns:
+        None
+    """
+    try:
+        app.redis.hincrby(COUNTERS_KEY, name, amount)
+    except redis.RedisError as e:
+        app.logger.warning(f'Unable to record metric {name}: {e}')
+
+def record_timing(name, seconds):
+    """
+    Record a timing sample. The most recent MAX_SAMPLES samples of every
+    timing are kept for percentile calculations.
+
+    Args:
+        name (str): The name of the timing, e.g. 'db_pool.wait'.
+        seconds (float): The duration measured.
+
+    Returns:
+        None
+    """
+    record_timings({name: seconds})
+
+def record_timings(samples):
+    """
+    Record several timing samples with a single Redis round trip.
+
+    Args:
+        samples (dict): The name of each timing to the duration measured.
+
+    Returns:
+        None
+    """
+    try:
+        pipe = app.redis.pipeline(transaction=False)
+        for name, seconds in samples.items():
+            pipe.sadd(TIMINGS_KEY, name)
+            pipe.lpush(SAMPLES_PREFIX + name, seconds)
+            pipe.ltrim(SAMPLES_PREFIX + name, 0, MAX_SAMPLES - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        app.logger.warning(f'Unable to record metrics {list(samples)}: {e}')
+
+class Timer:
+    """
+    Context manager recording the time spent in its block as a timing sample.
+
+        with Timer('db.lookup'):
+            ...
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        record_timing(self.name, self.elapsed)
+
+class Trace:
+    """
+    The stages of one process's part in handling a request.
+    """
+    def __init__(self, command, trace_id=None, process='web'):
+        self.command = command
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.process = process
+        self.stages = {}
+        self.fields = {}
+        self.start = time.perf_counter()
+        # Time spent in nested stages, per open stage
+        self._children = [0.0]
+
+    def add(self, stage, seconds):
+        """Add time spent outside of any stage() block to a stage."""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self):
+        """Record the trace's timings and log it."""
+        total = time.perf_counter() - self.start
+        prefix = f'command.{self.command}.'
+        samples = {prefix + stage: seconds
+                   for stage, seconds in self.stages.items()}
+        samples[prefix + self.process] = total
+        record_timings(samples)
+
+        line = {
+            'trace_id': self.trace_id,
+            'command': self.command,
+            'process': self.process,
+            'total_ms': round(total * 1000, 3),
+            'stages_ms': {stage: round(seconds * 1000, 3)
+                          for stage, seconds in self.stages.items()},
+        }
+        line.update(self.fields)
+        trace_log.info(json.dumps(line, sort_keys=True))
+
+def current_trace():
+    """Return the trace open on this thread, or None."""
+    return getattr(_local, 'trace', None)
+
+@contextmanager
+def trace(command, trace_id=None, process='web'):
+    """
+    Open a trace for the duration of the block.
+
+        with trace('dbmod.add', trace_id, process='worker') as t:
+            ...
+
+    Args:
+        command (str): The command being handled, e.g. 'lookup'.
+        trace_id (str): (Optional) The id of the request, a new id if None.
+        process (str): (Optional) The kind of process, 'web' or 'worker'.
+    """
+    previous = current_trace()
+    _local.trace = Trace(command, trace_id, process)
+    try:
+        yield _local.trace
+    finally:
+        finished, _local.trace = _local.trace, previous
+        finished.finish()
+
+@contextmanager
+def stage(name):
+    """
+    Add the time spent in the block to a stage of the current trace. Does
+    nothing outside of a trace. Stage names may not contain dots.
+    """
+    current = current_trace()
+    if current is None:
+        yield
+        return
+
+    current._children.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = current._children.pop()
+        current._children[-1] += elapsed
+        current.add(name, elapsed - nested)
+
+def staged(name):
+    """Decorator adding the time spent in a function to a trace stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def percentile(samples, pct):
+    """Return the pct percentile of a sorted list of samples."""
+    if len(samples) == 0:
+        return None
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+def summary():
+    """
+    Build a summary of every counter and timing recorded.
+
+    Returns:
+        A dict with a 'counters' dict of name to count and a 'timings' dict of
+        name to count, mean, p50, p95, p99 and max over the recent samples.
+        The timings of traced commands are also grouped under 'commands' by
+        command and stage.
+    """
+    counters = app.redis.hgetall(COUNTERS_KEY)
+    names = sorted(name.decode() for name in app.redis.smembers(TIMINGS_KEY))
+
+    pipe = app.redis.pipeline(transaction=False)
+    for name in names:
+        pipe.lrange(SAMPLES_PREFIX + name, 0, -1)
+    sample_lists = pipe.execute()
+
+    timings = {}
+    for name, samples in zip(names, sample_lists):
+        samples = sorted(float(sample) for sample in samples)
+        if len(samples) == 0:
+            continue
+        timings[name] = {
+            'count': len(samples),
+            'mean': sum(samples) / len(samples),
+            'p50': percentile(samples, 50),
+            'p95': percentile(samples, 95),
+            'p99': percentile(samples, 99),
+            'max': samples[-1],
+        }
+
+    # The same timings grouped by command, then stage
+    commands = {}
+    for name, timing in timings.items():
+        if name.startswith('command.'):
+            command, stage_name = name[len('command.'):].rsplit('.', 1)
+            commands.setdefault(command, {})[stage_name] = timing
+
+    return {
+        'counters': {k.decode(): int(v) for k, v in counters.items()},
+        'timings': timings,
+        'commands': commands,
+    }
@@ -0,0 +1,204 @@
+"""
+pool.py
+October 18, 2026
+
+This module manages the pool of PostgreSQL connections shared by the threads
+of a web or worker process. Connections are checked out for the length of a
+request or job with connection() and returned in a clean state afterwards.
+Connections that fail or sit idle too long are health checked and replaced.
+"""
+import os
+import time
+import functools
+import threading
+import psycopg2
+import psycopg2.extensions
+from contextlib import contextmanager
+from psycopg2.pool import PoolError
+from teamdict import app
+from teamdict import metrics
+
+# Connections checked out by the current thread, so nested calls share one
+_local = threading.local()
+_pool_lock = threading.Lock()
+
+class ConnectionPool:
+    """
+    Thread safe pool of connections to the database.
+
+    Unlike psycopg2's ThreadedConnectionPool, which raises as soon as every
+    connection is in use and closes connections returned while 'minconn' are
+    idle, getconn() waits up to 'timeout' seconds for one to be returned and
+    records how long it waited, and every connection returned healthy is kept
+    for reuse. At most 'maxconn' connections are open at once; 'minconn' are
+    opened up front.
+    """
+    def __init__(self, dsn, minconn, maxconn, timeout, check_after, **kwargs):
+        self.dsn = dsn
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.check_after = check_after
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # (connection, time.monotonic() it was returned), most recent last
+        self._idle = [(self.connect(), time.monotonic())
+                      for i in range(minconn)]
+
+    def connect(self):
+        """Open a new connection to the database."""
+        return psycopg2.connect(self.dsn, **self.kwargs)
+
+    def getconn(self):
+        """
+        Check a healthy connection out of the pool.
+
+        Returns:
+            A psycopg2 connection.
+
+        Raises:
+            PoolError if no connection is returned within the timeout.
+        """
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            metrics.incr('db_pool.timeouts')
+            raise PoolError(f'No connection available after {self.timeout}s')
+        metrics.record_timing('db_pool.wait', time.perf_counter() - start)
+
+        try:
+            with self._lock:
+                idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                return self.connect()
+
+            conn, last_used = idle
+            if not self.is_healthy(conn, last_used):
+                metrics.incr('db_pool.reconnects')
+                self.close(conn)
+                conn = self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool, rolling back anything left
+        uncommitted so the next user starts outside of a transaction.
+
+        Args:
+            conn (connection): The connection checked out with getconn().
+            close (bool): (Optional) Discard the connection instead of keeping
+                it for reuse.
+
+        Returns:
+            None
+        """
+        try:
+            if not close and not conn.closed:
+                status = conn.get_transaction_status()
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+        except psycopg2.Error:
+            close = True
+
+        if close or conn.closed:
+            self.close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def close(self, conn):
+        """Close a connection without letting a failure escape."""
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def is_healthy(self, conn, last_used):
+        """
+        Check that a connection is still usable. Connections idle for longer
+        than 'check_after' seconds are pinged with a trivial query.
+        """
+        if conn.closed:
+            return False
+
+        if time.monotonic() - last_used < self.check_after:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+def get_pool():
+    """
+    Return the connection pool for this process. A process forked from the
+    one that created the pool (such as an RQ work horse) must not share its
+    parent's sockets, so it is given a pool of its own.
+    """
+    pool = getattr(app, 'dbpool', None)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+
+    with _pool_lock:
+        pool = getattr(app, 'dbpool', None)
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(
+                    app.config['DATABASE_URL'],
+                    app.config['DB_POOL_MIN'],
+                    app.config['DB_POOL_MAX'],
+                    app.config['DB_POOL_TIMEOUT'],
+                    app.config['DB_POOL_CHECK_AFTER'],
+                    sslmode='require')
+            app.dbpool = pool
+    return pool
+
+@contextmanager
+def connection():
+    """
+    Check a connection out of the pool for the duration of the block.
+
+    Nested uses within the same thread share the outermost connection, so a
+    request or job holds at most one connection however many database
+    functions it calls. A connection that raises an operational error is
+    discarded rather than returned, and the next checkout reconnects.
+
+        with connection() as conn:
+            with conn.cursor() as cur:
+                ...
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    pool = get_pool()
+    with metrics.stage('db_pool'):
+        conn = pool.getconn()
+    _local.conn = conn
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        _local.conn = None
+        pool.putconn(conn, close=broken)
+
+def with_connection(func):
+    """
+    Decorator checking one connection out for the whole of a job, so every
+    database function the job calls shares it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with connection():
+            return func(*args, **kwargs)
+    return wrapper
@@ -7,21 +7,34 @@ This module defines functions to interface with a PostgreSQL database to
 create and drop tables, add and delete rows of key-value pairs, and lookup
 a key from one or many tables.
 
+Each "table" a user sees is a dictionary registered in the dictionaries table
+and its key-value pairs are rows of the shared entries table, see schema.py.
+Tables are still identified by their long form name
+<team_domain>_<channel_id>_<table_name> throughout the app.
+
 All methods in this module expect the command arguments to be formatted
 correctly.
 """
 
+import io
 import os
+import csv
 import psycopg2
 import psycopg2.extras
 from datetime import datetime
 from flask import request
 from hashlib import blake2b
-from teamdict import app
+from teamdict import app, cache, exports, metrics, sessions, uploads
+from teamdict.pool import connection
 from teamdict.slack import *
 
-conn = app.dbconn
+# Replaces the value of a key that already exists, leaving rows whose value
+# does not change untouched so their date modified is kept
+UPSERT_CONFLICT = ('ON CONFLICT (team_domain, channel_id, dictionary, key) ' +
+        'DO UPDATE SET value = EXCLUDED.value, date_modified = now() ' +
+        'WHERE entries.value IS DISTINCT FROM EXCLUDED.value ')
 
+@metrics.staged('db')
 def create_table(form):
     """
     Build and execute a query to create a table to the database given a table
@@ -39,23 +52,28 @@ def create_table(form):
     Returns:
         None
     """
-    with conn.cursor() as cur:
+    with connection() as conn, conn.cursor() as cur:
         short_name, table_name = get_table_names(form, 1)
         if table_name is None:
             return
 
-        query = ('CREATE TABLE %s (' +
-                 'key VARCHAR PRIMARY KEY, ' +
-                 'value VARCHAR, ' +
-                 'date_modified TIMESTAMPTZ NOT NULL DEFAULT now()' +
-                 ');'
+        query = ('INSERT INTO dictionaries (team_domain, channel_id, name) ' +
+                 'VALUES (%s, %s, %s) ' +
+                 'ON CONFLICT DO NOTHING;'
                  )
-        cur.execute(query, (as_is(table_name),))
+        cur.execute(query, split_table_name(table_name))
+        if cur.rowcount == 0:
+            send_delayed_message(
+                        f'Table `{short_name}` already exists.',
+                        form['response_url'])
+            return
+        conn.commit()
+        invalidate_table_cache(table_name)
         send_delayed_message(
                     f'Table `{short_name}` created!',
                     form['response_url'])
-        conn.commit()
 
+@metrics.staged('db')
 def drop_table(form):
     """
     Build and execute a query to drop a table from the database given the table
@@ -94,20 +112,25 @@ def drop_table(form):
                 )
     #Request coming from a button press in Slack
     else:
-        with conn.cursor() as cur:
+        with connection() as conn, conn.cursor() as cur:
             short_name, table_name = add_short_name(form['callback_id'])
             if not is_table(table_name):
                 send_delayed_message(
                         f'No table named `{short_name}` exists.',
                         form['response_url'])
                 return
-            query = 'DROP TABLE %s;'
-            cur.execute(query, (as_is(table_name),))
+            # Entries are removed along with the dictionary by the foreign key
+            query = ('DELETE FROM dictionaries ' +
+                    'WHERE team_domain = %s AND channel_id = %s AND name = %s;')
+            cur.execute(query, split_table_name(table_name))
+            conn.commit()
+            invalidate_table_cache(table_name)
+            cache.invalidate_table_values(table_name)
             send_delayed_message(
                         f'Table `{short_name}` dropped!',
                         form['response_url'], replace_original=True)
-            conn.commit()
 
+@metrics.staged('db')
 def add_data(form):
     """
     Add a row containing a key-value pair and the date in the table specified.
@@ -125,7 +148,7 @@ def add_data(form):
     Returns:
         None
     """
-    with conn.cursor() as cur:
+    with connection() as conn, conn.cursor() as cur:
         if 'table_name' in form:
             short_name, table_name = add_short_name(form['table_name'])
         if not 'table_name' in form:
@@ -136,76 +159,338 @@ def add_data(form):
         text = form['text'].split()
         key = text[2]
         value = ' '.join(text[3:])
-        query = ('INSERT INTO %s (key, value) ' +
-                'VALUES (%s, %s);')
+        query = ('INSERT INTO entries ' +
+                '(team_domain, channel_id, dictionary, key, value) ' +
+                'VALUES (%s, %s, %s, %s, %s);')
         try:
-            cur.execute(query, (as_is(table_name), key, value,))
+            cur.execute(query, split_table_name(table_name) + (key, value,))
         except psycopg2.IntegrityError:
-            #TODO: Ask user if they wish to update the value of duplicate key.
+            conn.rollback()
             send_delayed_message(
-                    f'Key `{key}` already exists in `{short_name}`',
+                    f'Key `{key}` already exists in `{short_name}`, use ' +
+                    f'`/dbmod set {short_name} {key} <value>` to change it',
                     form['response_url'])
             return
 
+        conn.commit()
+        cache.invalidate_values(table_name, [key])
         send_delayed_message(
                 f'Key `{key}` added to `{short_name}`',
                 form['response_url'])
-        conn.commit()
 
-def data_entry(form, url):
-    """Prepare a url for mass data entry"""
-    with conn.cursor() as cur:
-        response_url = form['response_url']
+@metrics.staged('db')
+def set_data(form):
+    """
+    Set the value of a key in the table specified, adding the key if it does
+    not exist yet. The key's date modified is only updated if its value
+    changes.
+
+    /dbmod set table key value
+
+    Args:
+        form (dict): Form data from the original POST request.
+
+    Returns:
+        None
+    """
+    with connection() as conn, conn.cursor() as cur:
         short_name, table_name = get_table_names(form, 1)
         if table_name is None:
             return
 
-        user_id = form['user_id']
-        channel_id = form['channel_id']
-        url_ext = blake2b(f'{user_id} {datetime.now()}'.encode('utf-8'),
-                          digest_size=15).hexdigest()
-        url = f'{url}data_entry/{url_ext}'
+        text = form['text'].split()
+        key = text[2]
+        value = ' '.join(text[3:])
+        names = split_table_name(table_name)
+        query = ('WITH existing AS (' +
+                'SELECT key FROM entries ' +
+                'WHERE team_domain = %s AND channel_id = %s ' +
+                'AND dictionary = %s AND key = %s' +
+                '), upserted AS (' +
+                'INSERT INTO entries ' +
+                '(team_domain, channel_id, dictionary, key, value) ' +
+                'VALUES (%s, %s, %s, %s, %s) ' +
+                UPSERT_CONFLICT +
+                'RETURNING key' +
+                ') SELECT existing.key IS NULL ' +
+                'FROM upserted LEFT JOIN existing USING (key);')
+        try:
+            cur.execute(query, names + (key,) + names + (key, value))
+            row = cur.fetchone()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+
+    if row is None:
+        message = f'Key `{key}` already has that value in `{short_name}`'
+    elif row[0]:
+        cache.invalidate_values(table_name, [key])
+        message = f'Key `{key}` added to `{short_name}`'
+    else:
+        cache.invalidate_values(table_name, [key])
+        message = f'Key `{key}` updated in `{short_name}`'
+    send_delayed_message(message, form['response_url'])
 
-        query = ('INSERT INTO data_entry_queue ' +
-                '(url_ext, table_name, response_url, user_id, channel_id) ' +
-                'VALUES (%s, %s, %s, %s, %s);')
-        cur.execute(query, (url_ext, table_name, response_url, user_id,
-                            channel_id,))
-
-        # Use api call for data_entry to allow for editing the message later
-        done_button = Button('done', 'Done', style='primary')
-        cancel_button = Button('cancel', 'Cancel')
-        buttons = [done_button.dict, cancel_button.dict]
-        atext = f'Link expires in two minutes\n<{url}>'
-        attachments = [{
-                'pretext': 'Data Entry',
-                'actions': buttons,
-                'text': atext,
-                'color': '#003F87',
-                'callback_id': url,
-                'fallback': url,
-                }]
-
-        token = app.config['ACCESS_TOKEN']
-        channel = form['channel_id']
-        user = form['user_id']
-        response = api_call('chat.postEphemeral', token=token, channel=channel,
-                user=user, attachments=json.dumps(attachments))
-
-        # Add message timestamp to data_entry queue
-        print(f'Message_ts from api_call response: {response["message_ts"]}')
-        message_ts = response['message_ts']
-        query = ('UPDATE data_entry_queue ' +
-                'SET message_ts = %s;')
-        cur.execute(query, (message_ts,))
+def bulk_add_data(table_name, rows, chunk_size=None, progress=None,
+                  overwrite=False):
+    """
+    Load many key-value pairs into the table specified. Rows are streamed into
+    a temporary staging table with COPY and moved into the dictionary with a
+    single INSERT per chunk. Every chunk is committed in its own transaction so
+    a failure part way through keeps the chunks already loaded.
+
+    Keys that already exist in the table are skipped, unless overwrite is set
+    in which case their values are replaced. Keys that appear more than once
+    in a chunk are only loaded once, keeping the first value or with
+    overwrite the last, and the repeats are reported back to the caller.
+
+    Args:
+        table_name (str): The long form name of the table.
+        rows (iterable): (key, value) tuples to be added.
+        chunk_size (int): (Optional) Number of rows loaded per transaction.
+        progress (function): (Optional) Called with the stats after every
+            chunk is committed. Loading stops if it returns False.
+        overwrite (bool): (Optional) Replace the values of existing keys.
+
+    Returns:
+        A dict with the number of 'rows' read, the number 'added' and
+        'updated', the Rejected 'duplicates' and whether the load was
+        'cancelled' by progress.
+    """
+    if chunk_size is None:
+        chunk_size = app.config['INGEST_CHUNK_SIZE']
+
+    stats = {'rows': 0, 'added': 0, 'updated': 0,
+             'duplicates': uploads.Rejected(), 'cancelled': False}
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            bulk_add_chunk(table_name, chunk, stats, overwrite)
+            chunk = []
+            if progress is not None and progress(stats) is False:
+                stats['cancelled'] = True
+                return stats
+    if len(chunk) > 0:
+        bulk_add_chunk(table_name, chunk, stats, overwrite)
+    if progress is not None:
+        progress(stats)
+
+    return stats
+
+@metrics.staged('db')
+def bulk_add_chunk(table_name, chunk, stats, overwrite=False):
+    """
+    Load one chunk of rows for bulk_add_data() and update its stats in place.
+    With overwrite the chunk is upserted in a single statement, which also
+    tells apart the keys added from those updated.
+
+    Args:
+        table_name (str): The long form name of the table.
+        chunk (list): (key, value) tuples to be added.
+        stats (dict): Running totals kept by bulk_add_data().
+        overwrite (bool): (Optional) Replace the values of existing keys.
+
+    Returns:
+        None
+    """
+    # Quote every field so empty values load as '' rather than NULL
+    buf = io.StringIO()
+    csv.writer(buf, quoting=csv.QUOTE_ALL).writerows(chunk)
+    buf.seek(0)
+
+    names = split_table_name(table_name)
+    with connection() as conn, conn.cursor() as cur:
+        try:
+            # line keeps the order of the input, so repeated keys resolve to
+            # their first value, or their last when overwriting
+            query = ('CREATE TEMP TABLE IF NOT EXISTS bulk_staging (' +
+                    'line SERIAL, ' +
+                    'key VARCHAR, ' +
+                    'value VARCHAR' +
+                    ') ON COMMIT DELETE ROWS;')
+            cur.execute(query)
+            cur.copy_expert(
+                    'COPY bulk_staging (key, value) FROM STDIN WITH CSV', buf)
+
+            if overwrite:
+                query = ('WITH existing AS (' +
+                        'SELECT key FROM entries ' +
+                        'WHERE team_domain = %s AND channel_id = %s ' +
+                        'AND dictionary = %s ' +
+                        'AND key IN (SELECT key FROM bulk_staging)' +
+                        '), upserted AS (' +
+                        'INSERT INTO entries ' +
+                        '(team_domain, channel_id, dictionary, key, value) ' +
+                        'SELECT DISTINCT ON (key) %s, %s, %s, key, value ' +
+                        'FROM bulk_staging ORDER BY key, line DESC ' +
+                        UPSERT_CONFLICT +
+                        'RETURNING key' +
+                        ') SELECT upserted.key, existing.key IS NULL ' +
+                        'FROM upserted LEFT JOIN existing USING (key);')
+                cur.execute(query, names + names)
+            else:
+                query = ('INSERT INTO entries ' +
+                        '(team_domain, channel_id, dictionary, key, value) ' +
+                        'SELECT DISTINCT ON (key) %s, %s, %s, key, value ' +
+                        'FROM bulk_staging ORDER BY key, line ' +
+                        'ON CONFLICT DO NOTHING ' +
+                        'RETURNING key, TRUE;')
+                cur.execute(query, names)
+            changed = dict(cur.fetchall())
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+
+    cache.invalidate_values(table_name, changed)
+    added = sum(1 for inserted in changed.values() if inserted)
+    stats['rows'] += len(chunk)
+    stats['added'] += added
+    stats['updated'] += len(changed) - added
+    seen = set()
+    for key, value in chunk:
+        if key in seen or (not overwrite and key not in changed):
+            stats['duplicates'].append(key)
+        seen.add(key)
+
+def data_entry(form, url):
+    """
+    Prepare a url for mass data entry.
+
+    /dbmod populate table [overwrite]
+
+    With overwrite the values of keys that already exist are replaced by the
+    uploaded ones instead of being skipped.
+    """
+    response_url = form['response_url']
+    short_name, table_name = get_table_names(form, 1)
+    if table_name is None:
+        return
+
+    text = form['text'].lower().split()
+    overwrite = len(text) > 2 and text[2] == 'overwrite'
+    user_id = form['user_id']
+    channel_id = form['channel_id']
+    url_ext = blake2b(f'{user_id} {datetime.now()}'.encode('utf-8'),
+                      digest_size=15).hexdigest()
+    url = f'{url}data_entry/{url_ext}'
+
+    # Use api call for data_entry to allow for editing the message later
+    done_button = Button('done', 'Done', style='primary')
+    cancel_button = Button('cancel', 'Cancel')
+    buttons = [done_button.dict, cancel_button.dict]
+    minutes = app.config['DATA_ENTRY_TTL'] // 60
+    atext = f'Link expires in {minutes} minutes\n<{url}>'
+    if overwrite:
+        atext = f'Existing keys will be overwritten\n{atext}'
+    attachments = [{
+            'pretext': 'Data Entry',
+            'actions': buttons,
+            'text': atext,
+            'color': '#003F87',
+            'callback_id': url,
+            'fallback': url,
+            }]
+
+    token = app.config['ACCESS_TOKEN']
+    channel = form['channel_id']
+    user = form['user_id']
+    response = api_call('chat.postEphemeral', token=token, channel=channel,
+            user=user, attachments=json.dumps(attachments))
+
+    # Start the session only once the message is posted, in a single write
+    # keyed by its url extension, so concurrent requests never touch each
+    # other's sessions
+    message_ts = response['message_ts']
+    sessions.create_session(url_ext, table_name=table_name,
+                            response_url=response_url, user_id=user_id,
+                            channel_id=channel_id, message_ts=message_ts,
+                            overwrite=int(overwrite))
+    if sessions.sweep_due():
+        app.queues['low'].enqueue(uploads.sweep_orphans)
+
+@metrics.staged('db')
+def delete_data(form, max_listed=20):
+    """
+    Delete rows from the specified table where the key matches any of the
+    given keys, in a single statement. Purges of keys older than an interval
+    are handed to purge_data(), as are the button presses confirming them.
+
+    /dbmod delete table key [key ...]
+    /dbmod delete table older-than interval
+
+    Args:
+        form (dict): Form data from the original POST request.
+        max_listed (int): (Optional) Most keys listed as deleted or not found.
 
+    Returns:
+        None
+    """
+    #Request coming from a button press in Slack
+    if 'text' not in form:
+        purge_data(form)
+        return
+
+    text = form['text'].lower().split()
+    if len(text) > 2 and text[2] == 'older-than':
+        purge_data(form)
+        return
+
+    with connection() as conn, conn.cursor() as cur:
+        short_name, table_name = get_table_names(form, 1)
+        if table_name is None:
+            return
+
+        # Drop repeated keys, keeping the order they were given in
+        keys = list(dict.fromkeys(text[2:]))
+        query = ('DELETE FROM entries ' +
+                'WHERE team_domain = %s AND channel_id = %s ' +
+                'AND dictionary = %s AND key = ANY(%s) ' +
+                'RETURNING key;')
+        cur.execute(query, split_table_name(table_name) + (keys,))
+        deleted = set(row[0] for row in cur.fetchall())
         conn.commit()
 
-def delete_data(form):
+    if len(deleted) > 0:
+        cache.invalidate_values(table_name, deleted)
+
+    if len(keys) == 1:
+        if len(deleted) > 0:
+            message = f'Key `{keys[0]}` deleted from `{short_name}`'
+        else:
+            message = f'Key `{keys[0]}` was not found in `{short_name}`'
+        send_delayed_message(message, form['response_url'])
+        return
+
+    plural_s = '' if len(deleted) == 1 else 's'
+    message = f'{len(deleted)} key{plural_s} deleted from `{short_name}`'
+    details = []
+    for label, listed in (('Deleted', [k for k in keys if k in deleted]),
+                          ('Not found', [k for k in keys if k not in deleted])):
+        if len(listed) > 0:
+            more = ' ...' if len(listed) > max_listed else ''
+            details.append(f'{label}: ' + ', '.join(listed[:max_listed]) +
+                           more)
+    send_delayed_message(message, form['response_url'],
+                         attachments='\n'.join(details))
+
+@metrics.staged('db')
+def purge_data(form):
     """
-    Delete a row from the specified table where the key matches the given key.
+    Delete every row of the specified table that has not been modified for
+    longer than the interval given, once the user has confirmed it. The
+    purge is a single statement served by the index on date_modified.
 
-    /dbmod delete table key
+    /dbmod delete table older-than interval
+
+    The interval is anything PostgreSQL reads as a positive one, e.g.
+    '30 days'. When the user is asked to confirm, the interval is turned into
+    a cutoff time, which is carried to the button press in the callback_id
+    between the table name and the interval. The purge deletes keys modified
+    before the cutoff, so it never deletes keys the confirmation did not
+    count.
 
     Args:
         form (dict): Form data from the original POST request.
@@ -213,26 +498,137 @@ def delete_data(form):
     Returns:
         None
     """
-    with conn.cursor() as cur:
+    #Request coming from a slash command directly
+    if 'text' in form:
         short_name, table_name = get_table_names(form, 1)
         if table_name is None:
             return
 
-        text = form['text'].lower().split()
-        key = text[2]
-        query = ('DELETE FROM %s ' +
-                'WHERE key = %s;')
-        cur.execute(query, (as_is(table_name), key,))
-        item_existed = int(cur.statusmessage.split()[1]) > 0
-        if item_existed:
+        interval = ' '.join(form['text'].lower().split()[3:])
+        usage = ('Give a positive interval to delete keys older than, ' +
+                 f'e.g. `/dbmod delete {short_name} older-than 30 days`')
+        if interval == '':
+            send_delayed_message(usage, form['response_url'])
+            return
+
+        query = ('SELECT count(*) FROM entries ' +
+                'WHERE team_domain = %s AND channel_id = %s ' +
+                'AND dictionary = %s AND date_modified < %s;')
+        with connection() as conn, conn.cursor() as cur:
+            try:
+                cur.execute("SELECT %s::interval > '0', now() - %s::interval;",
+                            (interval, interval))
+                positive, cutoff = cur.fetchone()
+            except psycopg2.DataError:
+                conn.rollback()
+                send_delayed_message(
+                        f'`{interval}` is not an interval, e.g. `30 days`',
+                        form['response_url'])
+                return
+            if not positive:
+                conn.rollback()
+                send_delayed_message(usage, form['response_url'])
+                return
+            cur.execute(query, split_table_name(table_name) + (cutoff,))
+            count = cur.fetchone()[0]
+            conn.rollback()
+
+        if count == 0:
             send_delayed_message(
-                    f'Key `{key}` deleted from `{short_name}`',
+                    f'No keys in `{short_name}` are older than {interval}',
                     form['response_url'])
-            conn.commit()
-        else:
+            return
+
+        plural_s = '' if count == 1 else 's'
+        purge_conf = {
+                "title": "Are you sure?",
+                "text": f"{count} key{plural_s} in {short_name} will be lost!",
+                "ok_text": "Confirm",
+                "dismiss_text": "Cancel"
+                }
+        purge_btn = Button('delete', f'Delete {count} key{plural_s}',
+                           danger = True, confirm=purge_conf)
+        cancel_btn = Button('cancel', 'Cancel')
+        buttons = [purge_btn, cancel_btn]
+        send_delayed_message(
+                f'Are you sure you want to delete {count} key{plural_s} ' +
+                f'older than {interval} from {short_name}?',
+                form['response_url'],
+                attachments='This action cannot be undone.',
+                callback_id=f'{table_name} {cutoff.isoformat()} {interval}',
+                buttons=buttons
+                )
+    #Request coming from a button press in Slack
+    else:
+        # Confirmations sent before cutoffs were carried have no cutoff
+        expired = 'This confirmation has expired, run the command again'
+        callback = form['callback_id'].split(' ', 2)
+        if len(callback) < 3:
+            send_delayed_message(expired, form['response_url'],
+                                 replace_original=True)
+            return
+        table_name, cutoff, interval = callback
+        short_name, table_name = add_short_name(table_name)
+        if not is_table(table_name):
             send_delayed_message(
-                    f'Key `{key}` was not found in `{short_name}`',
+                    f'No table named `{short_name}` exists.',
                     form['response_url'])
+            return
+
+        query = ('DELETE FROM entries ' +
+                'WHERE team_domain = %s AND channel_id = %s ' +
+                'AND dictionary = %s AND date_modified < %s::timestamptz;')
+        with connection() as conn, conn.cursor() as cur:
+            try:
+                cur.execute(query, split_table_name(table_name) + (cutoff,))
+            except psycopg2.DataError:
+                conn.rollback()
+                send_delayed_message(expired, form['response_url'],
+                                     replace_original=True)
+                return
+            count = cur.rowcount
+            conn.commit()
+        if count > 0:
+            cache.invalidate_table_values(table_name)
+
+        plural_s = '' if count == 1 else 's'
+        send_delayed_message(
+                f'{count} key{plural_s} older than {interval} deleted ' +
+                f'from `{short_name}`',
+                form['response_url'], replace_original=True)
+
+def export_table(form, url):
+    """
+    Send a link for downloading a table, as CSV or as one JSON object per
+    line. The download is served by the /export/<token> route.
+
+    /dbmod export table [csv|json]
+
+    Args:
+        form (dict): Form data from the original POST request.
+        url (str): The root url of the app.
+
+    Returns:
+        None
+    """
+    short_name, table_name = get_table_names(form, 1)
+    if table_name is None:
+        return
+
+    text = form['text'].lower().split()
+    fmt = text[2] if len(text) > 2 else 'csv'
+    if fmt not in exports.FORMATS:
+        send_delayed_message(
+                f'Unknown export format `{fmt}`, use csv or json.',
+                form['response_url'])
+        return
+
+    token = exports.create_link(table_name, fmt)
+    minutes = app.config['EXPORT_LINK_TTL'] // 60
+    send_delayed_message(
+            f'Download `{short_name}` as {fmt}: <{url}export/{token}>',
+            form['response_url'],
+            attachments=f'Link expires in {minutes} minutes')
 
 def show_tables(form):
     """
@@ -261,13 +657,18 @@ def show_tables(form):
                 form['response_url'],
                 attachments=short_name_str)
 
-#TODO: Add functionality to lookup multiple keys.
 def lookup(form):
     """
-    Lookup a value from the channel in which the command originated. If no
-    table is specified, all the tables are searched.
+    Lookup values from the channel in which the command originated. If the
+    last argument names a table in the channel only that table is searched,
+    otherwise all the tables are searched. However many keys are given they
+    are looked up together with a single query.
+
+    A single key may instead be a search, ranked by similarity for a fuzzy
+    search or alphabetically for a prefix search:
 
-    /lookup key [table]
+    /lookup ~term [table]
+    /lookup prefix* [table]
 
     Args:
         form (dict): Form data from the original POST request.
@@ -275,118 +676,269 @@ def lookup(form):
     Returns:
         None
     """
+    keys, table_names = parse_lookup(form, get_channel_tables(form))
+    if len(keys) == 1 and search_mode(keys[0]) is not None:
+        search_keys(form, keys[0], table_names)
+        return
+
+    found = lookup_values(form, keys, table_names)
+
+    message, attachments = lookup_reply(keys, found)
+    send_delayed_message(message, form['response_url'],
+                         attachments=attachments)
+
+def parse_lookup(form, table_names):
+    """
+    Split the arguments of a lookup into the keys and the tables to search.
+
+    Args:
+        form (dict): Form data from the original POST request.
+        table_names (list): Tuples containing the short and long forms of the
+            names of every table in the channel.
+
+    Returns:
+        A tuple containing the list of distinct keys, in the order given, and
+        the list of tables to search.
+    """
     text = form['text'].lower().split()
+    tables = {names[0]: names for names in table_names}
+    if len(text) > 1 and text[-1] in tables:
+        return (list(dict.fromkeys(text[:-1])), [tables[text[-1]]])
+    return (list(dict.fromkeys(text)), table_names)
 
-    key = text[0]
-    values_found = [] #List of tuples, e.g. [(table, val), (table2, val2)]
-    if len(text) == 1: #Find all instances of 'key' in all tables
-        table_names = get_channel_tables(form)
-        for names in table_names:
-            short_name = names[0]
-            value = lookup_helper(form, key, names)
-            if len(value) > 0:
-                values_found.append((short_name, value))
-    elif len(text) == 2: #Find 'key' in the given table name
-        names = get_table_names(form, 1)
-        if names[0] is None:
-            return
-        short_name = names[0]
-        value = lookup_helper(form, key, names)
-        values_found.append((short_name, value))
-    else:
-        send_delayed_message(
-                'Unable to execute command:',
-                form['response_url'],
-                attachments=f"form['command'] form['text']")
+def lookup_values(form, keys, table_names, cached_only=False):
+    """
+    Find the values of keys in the given tables. The lookup cache is checked
+    first and, unless it holds every key for every table, all of the keys are
+    found with a single indexed query whose results are cached.
+
+    Args:
+        form (dict): Form data from the original POST request.
+        keys (list): The keys for which we are searching.
+        table_names (list): Tuples containing the short and long forms of
+            the names of the tables to search.
+        cached_only (bool): (Optional) Give up rather than query the database
+            if the cache does not hold every value.
+
+    Returns:
+        A dict of each key to a list of (short_name, value) tuples for the
+        tables containing it, or None if cached_only and a value is missing.
+    """
+    pairs = [(table_name, key) for key in keys
+             for short_name, table_name in table_names]
+    values = cache.get_values(pairs, partial=not cached_only)
+    if len(values) < len(pairs):
+        if cached_only:
+            return None
+        versions = cache.value_versions([names[1] for names in table_names])
+        values = query_values(form, keys, table_names)
+        cache.set_values(values, versions)
+
+    found = {}
+    for key in keys:
+        found[key] = [(short_name, values[(table_name, key)])
+                      for short_name, table_name in table_names
+                      if values[(table_name, key)] is not None]
+    return found
+
+@metrics.staged('db')
+def query_values(form, keys, table_names):
+    """
+    Builds and executes the query for lookup_values().
+
+    Args:
+        form (dict): Form data from the original POST request.
+        keys (list): The keys for which we are searching.
+        table_names (list): Tuples containing the short and long forms of
+            the names of the tables to search.
+
+    Returns:
+        A dict of (table_name, key) to value, None for every key not in the
+        table, covering every table and key searched.
+    """
+    values = {(table_name, key): None for key in keys
+              for short_name, table_name in table_names}
+    if len(values) == 0:
+        return values
+
+    team_domain = form['team_domain'].lower()
+    channel_id = form['channel_id'].lower()
+    query = ('SELECT dictionary, key, value FROM entries ' +
+            'WHERE team_domain = %s AND channel_id = %s ' +
+            'AND key = ANY(%s)')
+    params = [team_domain, channel_id, keys]
+    if len(table_names) == 1:
+        query += ' AND dictionary = %s'
+        params.append(table_names[0][0])
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(query + ';', params)
+        rows = cur.fetchall()
+
+    prefix = cache.channel_prefix(team_domain, channel_id)
+    for dictionary, key, value in rows:
+        table_name = f'{prefix}_{dictionary}'
+        if (table_name, key) in values:
+            values[(table_name, key)] = value
+    return values
+
+def search_mode(key):
+    """
+    Find whether a lookup key is a search.
+
+    Args:
+        key (str): The key given to /lookup.
+
+    Returns:
+        A tuple of 'fuzzy' or 'prefix' and the term to search for, or None
+        if the key is to be looked up exactly.
+    """
+    if len(key) > 1 and key.startswith('~'):
+        return ('fuzzy', key[1:])
+    if len(key) > 1 and key.endswith('*'):
+        return ('prefix', key[:-1])
+    return None
+
+@metrics.staged('db')
+def search_keys(form, key, table_names):
+    """
+    Send a message listing the keys matching a fuzzy or prefix search. Both
+    searches are served by indexes on the entries table, see schema.py, and
+    return at most SEARCH_LIMIT keys.
+
+    Args:
+        form (dict): Form data from the original POST request.
+        key (str): The search, '~term' or 'prefix*'.
+        table_names (list): Tuples containing the short and long forms of
+            the names of the tables to search.
+
+    Returns:
+        None
+    """
+    mode, term = search_mode(key)
+    if len(table_names) == 0:
+        send_delayed_message(f'No keys found matching `{key}`.',
+                             form['response_url'])
         return
 
-    if len(values_found) == 0:
-        send_delayed_message(
-                f'No key found matching `{key}`.',
-                form['response_url'])
-    elif len(values_found) == 1:
-        send_delayed_message(
-                f'`{key}` found in {values_found[0][0]}:',
-                form['response_url'],
-                attachments=f'{key}: {values_found[0][1]}')
+    params = [form['team_domain'].lower(), form['channel_id'].lower()]
+    query = ('SELECT dictionary, key, value FROM entries ' +
+            'WHERE team_domain = %s AND channel_id = %s ')
+    if mode == 'fuzzy':
+        query += 'AND key %% %s '
+        params.append(term)
     else:
-        values_str = ''
-        for value_table_pair in values_found:
-            table = value_table_pair[0]
-            value = value_table_pair[1]
-            values_str += f'{table}: {value}\n'
-        send_delayed_message(
-                f'`{key}` found in {len(values_found)} tables:',
-                form['response_url'],
-                attachments=values_str)
+        query += "AND key LIKE %s ESCAPE '\\' "
+        params.append(escape_like(term) + '%')
+    if len(table_names) == 1:
+        query += 'AND dictionary = %s '
+        params.append(table_names[0][0])
+    if mode == 'fuzzy':
+        query += 'ORDER BY similarity(key, %s) DESC, key '
+        params.append(term)
+    else:
+        query += 'ORDER BY key '
+    query += 'LIMIT %s;'
+    params.append(app.config['SEARCH_LIMIT'])
+
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        rows = cur.fetchall()
 
+    if len(rows) == 0:
+        send_delayed_message(f'No keys found matching `{key}`.',
+                             form['response_url'])
+        return
+
+    plural_s = 's' if len(rows) > 1 else ''
+    lines = [f'{row_key} ({table}): {value}' for table, row_key, value in rows]
+    send_delayed_message(f'{len(rows)} key{plural_s} found matching `{key}`:',
+                         form['response_url'],
+                         attachments='\n'.join(lines))
 
-#TODO: document that this function does the query and returns the result
-# and that the lookup() function sends a message to slack once it gets all the
-# queries done.
-def lookup_helper(form, key, table_names):
+def lookup_reply(keys, found):
     """
-    Builds and executes a query for the lookup() function to allow for multiple
-    tables to be searched.
+    Build the reply to a lookup.
 
     Args:
-        form (dict): Form data from the original POST request.
-        key (str): The key for which we are searching.
-        table_names (tuple): A tuple containing the long and short forms of
-            the table name.
+        keys (list): The keys that were searched for.
+        found (dict): Each key to a list of (short_name, value) tuples for
+            the tables the key was found in.
 
     Returns:
-        A string containing the found value or an empty string if the key
-        is not found in the table.
+        A tuple containing the message and its attachment text.
     """
-    result = []
-    with conn.cursor() as cur:
+    if len(keys) == 1:
+        key = keys[0]
+        values_found = found[key]
+        if len(values_found) == 0:
+            return (f'No key found matching `{key}`.', '')
+        elif len(values_found) == 1:
+            return (f'`{key}` found in {values_found[0][0]}:',
+                    f'{key}: {values_found[0][1]}')
+        else:
+            values_str = ''
+            for value_table_pair in values_found:
+                table = value_table_pair[0]
+                value = value_table_pair[1]
+                values_str += f'{table}: {value}\n'
+            return (f'`{key}` found in {len(values_found)} tables:',
+                    values_str)
+
+    lines = []
+    missing = []
+    for key in keys:
+        if len(found[key]) == 0:
+            missing.append(key)
+        for table, value in found[key]:
+            lines.append(f'{key} ({table}): {value}')
+    if len(missing) > 0:
+        lines.append('Not found: ' + ', '.join(missing))
+
+    num_found = len(keys) - len(missing)
+    return (f'{num_found} of {len(keys)} keys found:', '\n'.join(lines))
+
+def cached_lookup(form):
+    """
+    Answer a lookup from the schema and lookup caches alone, without touching
+    the database, so it can be answered inside the original request.
 
-        short_name, table_name = table_names
-        if not is_table(table_name):
-            send_delayed_message(
-                    f'No table named `{short_name}` exists.',
-                    form['response_url'])
-            return ''
+    /lookup key [key ...] [table]
 
-        query = ('SELECT value FROM %s ' +
-                'WHERE key = %s;')
-        cur.execute(query, (as_is(table_name), key,))
-        result = cur.fetchall()
+    Args:
+        form (dict): Form data from the original POST request.
 
-    if len(result) > 0:
-        return result[0][0] #Extract value from a tuple in an array
-    else:
-        return result
+    Returns:
+        A tuple containing the message and its attachment text, or None if
+        the answer is not entirely cached.
+    """
+    text = form['text'].lower().split()
+    if len(text) == 0 or text[0] in ('help', 'show'):
+        return None
+
+    prefix = cache.channel_prefix(form['team_domain'], form['channel_id'])
+    tables = cache.get_channel_tables(prefix)
+    if tables is None:
+        return None
+
+    table_names = [add_short_name(table) for table in tables]
+    keys, table_names = parse_lookup(form, table_names)
+    if len(keys) == 1 and search_mode(keys[0]) is not None:
+        return None
+    found = lookup_values(form, keys, table_names, cached_only=True)
+    if found is None:
+        return None
+    return lookup_reply(keys, found)
 
 def verify_ext(ext):
-    """take an extension from /data_entry/<ext> and ensure it's in the
-    data_entry_queue table"""
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        query = ('SELECT * FROM data_entry_queue WHERE ' +
-                'url_ext = %s;')
-        cur.execute(query, (ext,))
-        results = cur.fetchone()
-        #Check if request has not expired
-        if results is None or results['exp_date'] < datetime.now():
-            results = []
-
-        return results
+    """take an extension from /data_entry/<ext> and return its data entry
+    session, empty if it has expired"""
+    return sessions.get_session(ext)
 
 def fetch_data_entry_row(ext):
-    """take an extension from /data_entry/<ext> and ensure it's in the
-    data_entry_queue table"""
-    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        query = ('DELETE FROM data_entry_queue WHERE ' +
-                'url_ext = %s RETURNING *;')
-        cur.execute(query, (ext,))
-        results = cur.fetchone()
-        #Check if request has not expired
-        if results is None or results['exp_date'] < datetime.now():
-            results = []
-        conn.commit()
-
-        return results
+    """take an extension from /data_entry/<ext> and end its data entry
+    session, returning the session or empty if it had expired"""
+    return sessions.pop_session(ext)
 
 #######################
 #  UTILITY FUNCTIONS  #
@@ -447,20 +999,38 @@ def get_channel_tables(form):
         A list of tuples each containing the short and long form of the
         table name found.
     """
-    short_long_names = []
-    with conn.cursor() as cur:
-        team_domain = form['team_domain']
-        channel_id = form ['channel_id']
-        table_prefix = f"^{team_domain}_{channel_id}".lower()
+    tables = list_channel_tables(form['team_domain'], form['channel_id'])
+    return [add_short_name(table) for table in tables]
 
-        query = ('SELECT table_name ' +
-                'FROM information_schema.tables ' +
-                'WHERE table_name ~ %s;')
-        cur.execute(query, (table_prefix,))
-        tables = [table[0] for table in cur.fetchall()]
-        short_long_names = [add_short_name(table) for table in tables]
+@metrics.staged('tables')
+def list_channel_tables(team_domain, channel_id):
+    """
+    List the long form names of every table in a channel. The list is served
+    from the schema cache when possible and only read from the dictionaries
+    table on a cache miss.
 
-    return short_long_names
+    Args:
+        team_domain (str): The workspace's Slack domain.
+        channel_id (str): The id of the channel.
+
+    Returns:
+        A list of long form table names.
+    """
+    prefix = cache.channel_prefix(team_domain, channel_id)
+    tables = cache.get_channel_tables(prefix)
+    if tables is not None:
+        return tables
+
+    version = cache.channel_tables_version(prefix)
+    with connection() as conn, conn.cursor() as cur:
+        query = ('SELECT name FROM dictionaries ' +
+                'WHERE team_domain = %s AND channel_id = %s ' +
+                'ORDER BY name;')
+        cur.execute(query, (team_domain.lower(), channel_id.lower(),))
+        tables = [f'{prefix}_{table[0]}' for table in cur.fetchall()]
+
+    cache.set_channel_tables(prefix, tables, version)
+    return tables
 
 def is_table(table_name):
     """
@@ -474,16 +1044,44 @@ def is_table(table_name):
         False if table does not exist
     """
     table_name = table_name.lower()
-    with conn.cursor() as cur:
-        query = ('SELECT EXISTS (' +
-                'SELECT 1 FROM pg_tables ' +
-                'WHERE tablename = %s' +
-                ');'
-                )
-        cur.execute(query, (table_name,))
-        result = cur.fetchone()[0]
+    name = table_name.split('_')
+    if len(name) < 3:
+        return False
+
+    return table_name in list_channel_tables(name[0], name[1])
+
+def invalidate_table_cache(table_name):
+    """
+    Forget the cached table list of the channel a table belongs to.
+
+    Args:
+        table_name (str): The long form name of the table.
+
+    Returns:
+        None
+    """
+    team_domain, channel_id, short_name = split_table_name(table_name)
+    cache.invalidate_channel_tables(cache.channel_prefix(team_domain,
+                                                         channel_id))
+
+def split_table_name(table_name):
+    """
+    Split the long form name of a table into the columns identifying its
+    dictionary in the database. The input is expected to match the format
+    of table names specified in create_table().
+
+    Args:
+        table_name (str): The long form name of the table.
+
+    Returns:
+        A (team_domain, channel_id, short_name) tuple.
+    """
+    team_domain, channel_id, short_name = table_name.lower().split('_', 2)
+    return (team_domain, channel_id, short_name)
 
-    return result
+def escape_like(term):
+    """Escape the characters LIKE treats as wildcards in a search term."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
 def as_is(table_name):
     """Returns an AsIs object to avoid quoted table_names for db queries."""
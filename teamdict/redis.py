@@ -6,22 +6,73 @@ October 4, 2018
 This module takes a POST request from flask originating from Slack and queues
 a job to handle the incomming request in a Redis queue. After the task is
 queued, a 200 response is sent to confirm receipt of payload. For the purposes
-of this module, the request is assumed to be a POST request.
+of this module, the request is assumed to be a POST request that has already
+been verified by teamdict.validate.
 """
 import rq
 import json
+import functools
 from redis import Redis
 from flask import request
-from teamdict import app
+from teamdict import app, envelope, metrics
 from teamdict.util import *
 
-def queue_task(request, req_body, job_type, **extras):
+# The queue each kind of job is sent to. Jobs a user is waiting on go to
+# 'high' so they are never held up by bulk loads on 'low'.
+JOB_QUEUES = {
+    'lookup': 'high',
+    'response': 'high',
+    'cancel': 'high',
+    'modify': 'default',
+    'continue': 'low',
+}
+
+def get_queue(job_type):
+    """Return the queue jobs of a type are sent to."""
+    return app.queues[JOB_QUEUES.get(job_type, 'default')]
+
+def trace_request(job_type):
     """
-    Enqueue a job in the Redis queue.
+    Decorator tracing the web process's handling of a Slack request. The
+    trace takes the id the router gave the request, so the worker's part of
+    the trace and the router's logs can be matched up with it. Must be
+    applied below verify_slack_request(), so only verified requests are
+    traced and recorded in the metrics.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'POST':
+                return view(*args, **kwargs)
+            # Keep the raw body before the form is parsed, as parsing it
+            # consumes the stream verify_slack_request() signs
+            request.get_data(cache=True)
+            form = request.form.to_dict()
+            if job_type == 'response':
+                try:
+                    form = json.loads(form.get('payload', '{}'))
+                except ValueError:
+                    # Rejected by the view
+                    form = {}
+                if not isinstance(form, dict):
+                    form = {}
+            command = envelope.command_name(job_type, form)
+            trace_id = request.headers.get('X-Request-Id')
+            with metrics.trace(command, trace_id, process='web') as t:
+                response = view(*args, **kwargs)
+                status = response[1] if isinstance(response, tuple) else 200
+                t.fields['status'] = status
+                return response
+        return wrapper
+    return decorator
+
+def queue_task(request, job_type, **extras):
+    """
+    Enqueue a job in the Redis queue. The job is given a compact envelope of
+    the request built by teamdict.envelope rather than the whole request.
 
     Args:
         request (Request): The request object from flask.
-        req_body (str): Text representation of the request for validation.
         job_type (str): Describes what functions the command has access to.
 
     Kwargs:
@@ -31,17 +82,24 @@ def queue_task(request, req_body, job_type, **extras):
         A tuple containing the empty string and the integer 200 to respond to
         the original request.
     """
-    headers = dict(request.headers.to_list())
     form = request.form.to_dict()
+    queue = get_queue(job_type)
+    trace = metrics.current_trace()
+    trace_id = trace.trace_id if trace is not None else None
+    command = trace.command if trace is not None else None
 
-    if job_type == 'response':
-        form = json.loads(form['payload'])
-        job_data = JobData(headers, form, req_body, job_type)
-        rq_job = app.task_queue.enqueue(triage_response, job_data)
-    else:
-        url = request.url_root
-        job_data = JobData(headers, form, req_body, job_type, url=url)
-        rq_job = app.task_queue.enqueue(triage_command, job_data)
+    with metrics.stage('enqueue'):
+        if job_type == 'response':
+            form = json.loads(form['payload'])
+            payload = envelope.pack(job_type, form, trace_id=trace_id,
+                                    command=command)
+            rq_job = queue.enqueue(triage_response, payload)
+        else:
+            payload = envelope.pack(job_type, form, url=request.url_root,
+                                    trace_id=trace_id, command=command)
+            rq_job = queue.enqueue(triage_command, payload)
+    if trace is not None:
+        trace.fields['queue'] = queue.name
     return ('', 200)
 
 def queue_util(job_func, type, **extras):
@@ -50,11 +108,12 @@ def queue_util(job_func, type, **extras):
 
     Args:
         job_func (function): The function to be called.
+        type (str): The kind of job, which decides the queue it is sent to.
 
     Kwargs:
         extras: (Optional) Arguments for the job_func function.
     """
-    rq_job = app.task_queue.enqueue(job_func, kwargs=extras)
+    rq_job = get_queue(type).enqueue(job_func, kwargs=extras)
     rq_job.meta['type'] = type
     rq_job.save_meta()
     response_json = {
@@ -64,14 +123,3 @@ def queue_util(job_func, type, **extras):
         }
     }
     return response_json
-
-
-class JobData:
-    """JobData object for communicating a job's data to triage_command()"""
-    def __init__(self, headers, form, body, job_type, url='', data={}):
-        self.headers = headers
-        self.form = form
-        self.body = body
-        self.job_type = job_type
-        self.url = url
-        self.data = data
@@ -0,0 +1,150 @@
+"""
+schema.py
+October 18, 2026
+
+This module creates the tables the app stores its data in. Every dictionary
+is registered in the dictionaries table and all of their key-value pairs are
+kept together in the entries table, keyed by
+
+    (team_domain, channel_id, dictionary, key)
+
+When ENTRIES_PARTITIONS is set the entries table is hash partitioned by
+channel into that many partitions. Partitioning only takes effect when the
+entries table is first created.
+
+Fuzzy key searches use the pg_trgm extension, and btree_gin so a channel's
+keys can be searched with a single trigram index.
+
+Every statement is idempotent so create_schema() may be run on every deploy.
+"""
+
+def create_schema(conn, partitions=0):
+    """
+    Create any of the app's tables and indexes that do not yet exist.
+
+    Args:
+        conn (connection): The database connection to use.
+        partitions (int): (Optional) Number of hash partitions to create the
+            entries table with, 0 for an unpartitioned table.
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+        cur.execute('CREATE EXTENSION IF NOT EXISTS btree_gin;')
+
+        query = ('CREATE TABLE IF NOT EXISTS dictionaries (' +
+                'team_domain VARCHAR NOT NULL, ' +
+                'channel_id VARCHAR NOT NULL, ' +
+                'name VARCHAR NOT NULL, ' +
+                'date_created TIMESTAMPTZ NOT NULL DEFAULT now(), ' +
+                'PRIMARY KEY (team_domain, channel_id, name)' +
+                ');')
+        cur.execute(query)
+
+        partition_by = ''
+        if partitions > 0:
+            partition_by = ' PARTITION BY HASH (team_domain, channel_id)'
+        query = ('CREATE TABLE IF NOT EXISTS entries (' +
+                'team_domain VARCHAR NOT NULL, ' +
+                'channel_id VARCHAR NOT NULL, ' +
+                'dictionary VARCHAR NOT NULL, ' +
+                'key VARCHAR NOT NULL, ' +
+                'value VARCHAR, ' +
+                'date_modified TIMESTAMPTZ NOT NULL DEFAULT now(), ' +
+                'PRIMARY KEY (team_domain, channel_id, dictionary, key), ' +
+                'FOREIGN KEY (team_domain, channel_id, dictionary) ' +
+                'REFERENCES dictionaries (team_domain, channel_id, name) ' +
+                'ON DELETE CASCADE' +
+                ')' + partition_by + ';')
+        cur.execute(query)
+
+        for remainder in range(partitions):
+            query = (f'CREATE TABLE IF NOT EXISTS entries_p{remainder} ' +
+                    'PARTITION OF entries FOR VALUES WITH ' +
+                    f'(MODULUS {partitions}, REMAINDER {remainder});')
+            cur.execute(query)
+
+    conn.commit()
+    create_indexes(conn)
+
+# The indexes on entries, by name. Built with CREATE INDEX CONCURRENTLY, so
+# building one on a large table does not block the release still serving.
+ENTRIES_INDEXES = [
+    # Serves exact and prefix lookups across every dictionary in a channel
+    ('entries_channel_key_pattern_idx',
+     '(team_domain, channel_id, key varchar_pattern_ops)'),
+    # Serves fuzzy lookups ranked by trigram similarity
+    ('entries_channel_key_trgm_idx',
+     'USING gin (team_domain, channel_id, key gin_trgm_ops)'),
+    # Serves purges of a dictionary's keys by age
+    ('entries_channel_dictionary_modified_idx',
+     '(team_domain, channel_id, dictionary, date_modified)'),
+]
+
+# Indexes that have been replaced
+DROPPED_INDEXES = [
+    # Could only serve exact lookups
+    'entries_channel_key_idx',
+]
+
+def create_indexes(conn):
+    """
+    Create any of the indexes on entries that do not yet exist, without
+    locking the table against writes. Concurrent builds cannot run in a
+    transaction, so the connection is put in autocommit mode meanwhile.
+
+    PostgreSQL cannot build an index on a partitioned table concurrently,
+    so a partitioned entries table has its index created on the parent only
+    and built concurrently on each partition, which is then attached.
+
+    Args:
+        conn (connection): The database connection to use.
+
+    Returns:
+        None
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for name in DROPPED_INDEXES:
+                cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+
+            partitions = entries_partitions(cur)
+            for name, definition in ENTRIES_INDEXES:
+                if len(partitions) == 0:
+                    create_index(cur, name, 'entries', definition)
+                    continue
+
+                cur.execute(f'CREATE INDEX IF NOT EXISTS {name} ' +
+                            f'ON ONLY entries {definition};')
+                for partition in partitions:
+                    index = partition + name[len('entries'):]
+                    create_index(cur, index, partition, definition)
+                    cur.execute(f'ALTER INDEX {name} ' +
+                                f'ATTACH PARTITION {index};')
+    finally:
+        conn.autocommit = autocommit
+
+def create_index(cur, name, table, definition):
+    """
+    Build an index concurrently unless it exists. A build that failed part
+    way leaves an invalid index behind, which is dropped and built again.
+    """
+    query = ('SELECT NOT indisvalid FROM pg_index ' +
+            'WHERE indexrelid = to_regclass(%s);')
+    cur.execute(query, (name,))
+    row = cur.fetchone()
+    if row is not None and row[0]:
+        cur.execute(f'DROP INDEX CONCURRENTLY {name};')
+    cur.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ' +
+                f'ON {table} {definition};')
+
+def entries_partitions(cur):
+    """Return the names of the entries table's partitions, if it has any."""
+    query = ('SELECT inhrelid::regclass::text FROM pg_inherits ' +
+            "WHERE inhparent = 'entries'::regclass ORDER BY 1;")
+    cur.execute(query)
+    return [row[0] for row in cur.fetchall()]
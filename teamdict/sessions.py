@@ -0,0 +1,105 @@
+"""
+sessions.py
+October 18, 2026
+
+This module keeps the data entry sessions created by /dbmod populate. Each
+session is a Redis hash named after its url extension,
+
+    teamdict:data_entry:<url_ext>
+
+that Redis expires DATA_ENTRY_TTL seconds after it is created, or after the
+last chunk of an upload arrived, so checking a link is a single lookup and
+expired sessions never have to be deleted. The
+files uploaded during sessions that expire are removed by
+uploads.sweep_orphans().
+"""
+from teamdict import app
+
+SESSION_PREFIX = 'teamdict:data_entry:'
+SWEEP_LOCK = 'teamdict:data_entry_sweep'
+
+def session_key(ext):
+    """Build the Redis key of a data entry session."""
+    return SESSION_PREFIX + ext
+
+def decode(session):
+    """Convert a hash fetched from Redis into a dict of str."""
+    return {k.decode('utf-8'): v.decode('utf-8') for k, v in session.items()}
+
+def create_session(ext, **fields):
+    """
+    Start a data entry session that expires after DATA_ENTRY_TTL seconds. The
+    session is written with its expiry in one transaction, so it is never
+    seen half written or without a TTL.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Kwargs:
+        The session's fields, such as table_name and response_url.
+
+    Returns:
+        None
+    """
+    key = session_key(ext)
+    pipe = app.redis.pipeline()
+    pipe.hmset(key, fields)
+    pipe.expire(key, app.config['DATA_ENTRY_TTL'])
+    pipe.execute()
+
+def get_session(ext):
+    """
+    Fetch a data entry session.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Returns:
+        A dict of the session's fields, empty if the session does not exist
+        or has expired.
+    """
+    return decode(app.redis.hgetall(session_key(ext)))
+
+def pop_session(ext):
+    """
+    Fetch and end a data entry session in one step, so only one job can
+    claim it.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Returns:
+        A dict of the session's fields, empty if the session does not exist
+        or has expired.
+    """
+    key = session_key(ext)
+    pipe = app.redis.pipeline()
+    pipe.hgetall(key)
+    pipe.delete(key)
+    session, deleted = pipe.execute()
+    return decode(session)
+
+def extend_session(ext):
+    """
+    Push a data entry session's expiry DATA_ENTRY_TTL seconds into the
+    future, so an upload that is still arriving keeps its session alive.
+
+    Returns:
+        False if the session does not exist or has expired.
+    """
+    return bool(app.redis.expire(session_key(ext), app.config['DATA_ENTRY_TTL']))
+
+def session_exists(ext):
+    """Return True if a data entry session has not ended or expired."""
+    return bool(app.redis.exists(session_key(ext)))
+
+def sweep_due():
+    """
+    Claim the next sweep of orphaned uploads, at most once every
+    UPLOAD_SWEEP_INTERVAL seconds across every process.
+
+    Returns:
+        True if the caller should queue a sweep.
+    """
+    interval = app.config['UPLOAD_SWEEP_INTERVAL']
+    return bool(app.redis.set(SWEEP_LOCK, 1, ex=interval, nx=True))
@@ -6,10 +6,28 @@ October 4, 2018
 This module interfaces directly with the Slack API to perform actions
 necessary to communicate with the end user in Slack such as sending messages
 in response to the use of a slash command.
+
+Every request goes through one keep-alive session per process. When
+SLACK_SEND_QUEUE is enabled, messages sent to a response_url are handed to a
+background thread instead of being posted inline, so database work never
+waits on Slack. Jobs must call flush() (or be wrapped with flush_after) so
+queued messages are delivered before the process exits.
 """
 
+import os
 import json
+import time
+import queue
+import functools
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from teamdict import app, metrics
+
+_session = None
+_session_pid = None
+_outbound = None
+_lock = threading.Lock()
 
 def send_help(command, response_url, message=''):
     """
@@ -34,11 +52,7 @@ def delete_original_msg(response_url):
     """Deletes a message at the invocation of a cancelling button press"""
     headers = {'Content-type': 'application/json'}
     payload_dict = {'delete_original': True}
-    req = requests.post(
-            response_url,
-            data=json.dumps(payload_dict),
-            headers=headers
-        )
+    deliver(response_url, json.dumps(payload_dict), headers)
 
 def send_delayed_message(message, response_url, callback_id='',
                         attachments='', buttons=[], replace_original=False,
@@ -60,11 +74,28 @@ def send_delayed_message(message, response_url, callback_id='',
     Returns:
         None
     """
-    if len(buttons) > 0:
-        buttons = [btn.dict for btn in buttons]
+    payload_dict = build_message(message, callback_id, attachments, buttons,
+                                 replace_original, response_type)
 
     # Slack requires the Content-type header be application/json
     headers = {'Content-type': 'application/json'}
+    deliver(response_url, json.dumps(payload_dict), headers)
+
+def build_message(message, callback_id='', attachments='', buttons=[],
+                  replace_original=False, response_type='ephemeral'):
+    """
+    Build the payload of a message, as sent by send_delayed_message() or
+    returned directly in the response to a slash command.
+
+    Args:
+        See send_delayed_message().
+
+    Returns:
+        A dict ready to be serialized as the JSON body of the message.
+    """
+    if len(buttons) > 0:
+        buttons = [btn.dict for btn in buttons]
+
     payload_dict = {
         'response_type': response_type,
         'text': message,
@@ -79,13 +110,7 @@ def send_delayed_message(message, response_url, callback_id='',
             }
         ]
     }
-
-    req = requests.post(
-            response_url,
-            data=json.dumps(payload_dict),
-            headers=headers
-        )
-
+    return payload_dict
 
 def api_call(method, token=None, **data):
     """
@@ -101,7 +126,7 @@ def api_call(method, token=None, **data):
     Returns:
         JSON response from Slack
     """
-    post_url = f'https://slack.com/api/{method}'
+    post_url = f'{app.config["SLACK_API_URL"]}{method}'
     if data is not None and token is None and 'token' in data:
         token = data['token']
     headers = {
@@ -109,10 +134,143 @@ def api_call(method, token=None, **data):
             'Authorization': f'Bearer {token}'
             }
 
-    req = requests.post(post_url, headers=headers, data=data)
+    req = post(post_url, headers=headers, data=data)
     json_response = json.loads(req.text)
     return json_response
 
+def get_session():
+    """
+    Return this process's keep-alive session, creating it on first use. A
+    forked process gets a session of its own rather than sharing sockets
+    with its parent.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            pool_size = app.config['SLACK_POOL_SIZE']
+            # Only failed connections are retried, a retried POST could
+            # deliver the same message twice
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                                  max_retries=2)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pid = os.getpid()
+    return _session
+
+def post(url, **kwargs):
+    """
+    POST to Slack through the shared session with the configured timeout.
+
+    Args:
+        url (str): The url to POST to.
+
+    Kwargs:
+        kwargs: Arguments passed on to requests.Session.post().
+
+    Returns:
+        The requests.Response received.
+    """
+    kwargs.setdefault('timeout', app.config['SLACK_TIMEOUT'])
+    with metrics.stage('slack'), metrics.Timer('slack.request'):
+        return get_session().post(url, **kwargs)
+
+def deliver(url, data, headers):
+    """
+    Send a message POST to a response_url, through the outbound queue when
+    SLACK_SEND_QUEUE is enabled and inline otherwise.
+
+    Args:
+        url (str): The url to POST to.
+        data (str): The body of the POST.
+        headers (dict): The headers of the POST.
+
+    Returns:
+        None
+    """
+    if app.config['SLACK_SEND_QUEUE']:
+        get_outbound_queue().put(url, data, headers)
+    else:
+        OutboundQueue.send(url, data, headers, time.perf_counter())
+
+def get_outbound_queue():
+    """Return this process's outbound queue, starting it on first use."""
+    global _outbound
+    with _lock:
+        if _outbound is None or _outbound.pid != os.getpid():
+            _outbound = OutboundQueue()
+    return _outbound
+
+def flush(timeout=None):
+    """
+    Wait until every queued message has been delivered.
+
+    Args:
+        timeout (float): (Optional) Most seconds to wait, defaults to
+            SLACK_FLUSH_TIMEOUT.
+
+    Returns:
+        True if the queue was emptied, False if the wait timed out.
+    """
+    if _outbound is None or _outbound.pid != os.getpid():
+        return True
+    if timeout is None:
+        timeout = app.config['SLACK_FLUSH_TIMEOUT']
+    return _outbound.flush(timeout)
+
+def flush_after(func):
+    """Decorator delivering any queued messages once a job returns."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+class OutboundQueue:
+    """
+    Delivers messages in the order they were queued from a background thread.
+    The time from queueing to delivery of every message is recorded as the
+    'slack.delivery' timing.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, url, data, headers):
+        self.queue.put((url, data, headers, time.perf_counter()))
+
+    def run(self):
+        while True:
+            url, data, headers, queued_at = self.queue.get()
+            try:
+                self.send(url, data, headers, queued_at)
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    @staticmethod
+    def send(url, data, headers, queued_at):
+        try:
+            post(url, data=data, headers=headers)
+        except requests.RequestException as e:
+            metrics.incr('slack.errors')
+            app.logger.error(f'Unable to deliver message to Slack: {e}')
+            return
+        metrics.record_timing('slack.delivery', time.perf_counter() - queued_at)
+
 class Button:
     """
     Button object for easily sending buttons to send_delayed_message()
@@ -1,15 +1,108 @@
+// Send files in chunks so large uploads survive router timeouts. Each file
+// gets an id derived from the file itself, so if an upload is interrupted
+// and the same file is added again the server reports how much of it has
+// already arrived and only the rest is sent.
+Dropzone.options.dzstyle = {
+  chunking: true,
+  forceChunking: true,
+  chunkSize: 2 * 1024 * 1024,
+  retryChunks: true,
+  retryChunksLimit: 5,
+  acceptedFiles: '.csv,.txt',
+
+  accept: function(file, done) {
+    const dropzone = this;
+    file.upload.uuid = uploadId(file);
+    file.upload.resumeOffset = 0;
+    $.ajax({
+      url: window.location.pathname,
+      data: { dzuuid: file.upload.uuid },
+      method: 'GET'
+    })
+    .done((res) => {
+      const offset = res.data.offset;
+      const remaining = file.size - offset;
+      file.upload.resumeOffset = offset;
+      file.upload.totalChunkCount = Math.max(1,
+        Math.ceil(remaining / dropzone.options.chunkSize));
+      done();
+    })
+    .fail((err) => {
+      console.log(err);
+      done();
+    });
+  },
+
+  // Only the part of the file the server does not have yet is chunked
+  transformFile: function(file, done) {
+    done(file.slice(file.upload.resumeOffset));
+  },
+
+  params: function(files, xhr, chunk) {
+    if (chunk) {
+      const offset = chunk.file.upload.resumeOffset +
+        chunk.index * this.options.chunkSize;
+      return {
+        dzuuid: chunk.file.upload.uuid,
+        dzchunkindex: chunk.index,
+        dztotalfilesize: chunk.file.size,
+        dzchunksize: this.options.chunkSize,
+        dztotalchunkcount: chunk.file.upload.totalChunkCount,
+        dzchunkbyteoffset: offset
+      };
+    }
+  }
+};
+
+function uploadId(file) {
+  // FNV-1a hash of the session and the file's name, size and date
+  const str = [window.location.pathname, file.name, file.size,
+               file.lastModified].join(':');
+  let hash = 0x811c9dc5;
+  for (let i = 0; i < str.length; i++) {
+    hash ^= str.charCodeAt(i);
+    hash = Math.imul(hash, 0x01000193) >>> 0;
+  }
+  return hash.toString(16) + '-' + file.size.toString(16);
+}
+
+// Describe the progress an import job reports, e.g.
+// "1200 rows processed, 3 rejected, about 40s left"
+function progressText(progress) {
+  let text = progress.rows_processed + ' rows processed, ' +
+             progress.rows_rejected + ' rejected';
+  if (progress.eta_seconds !== null) {
+    text += ', about ' + Math.ceil(progress.eta_seconds) + 's left';
+  }
+  return text;
+}
+
 $( document ).ready(() => {
   console.log('sanity check');
+  // The running import, so cancelling can stop it part way through
+  let importTaskID = null;
 
   $('button').on('click', function(e) {
-    console.log('Button ' + $(this).attr('name') + 'clicked!')
+    const navigation = $(this).attr('name');
+    console.log('Button ' + navigation + 'clicked!')
     e.preventDefault();
+    const data = { navigation: navigation };
+    if (navigation === 'cancel' && importTaskID !== null) {
+      data.import_task_id = importTaskID;
+    }
     $.ajax({
       url: window.location.pathname,
-      data: { navigation: $(this).attr('name') },
+      data: data,
       method: 'POST'
     })
     .done((res) => {
+      if (navigation === 'cancel' && importTaskID !== null) {
+        // The import is already being polled and stops at its next chunk
+        return;
+      }
+      if (navigation === 'continue') {
+        importTaskID = res.data.task_id;
+      }
       getStatus(res.data.task_id);
     })
     .fail((err) => {
@@ -29,6 +122,9 @@ $( document ).ready(() => {
       if (status === 'finished' || status === 'failed') {
         window.location.href = res.data.redirect;
       }
+      if (res.data.progress) {
+        $('.result').text(progressText(res.data.progress));
+      }
       setTimeout(function() {
         getStatus(taskID);
       }, 500);
@@ -0,0 +1,455 @@
+"""
+uploads.py
+October 18, 2026
+
+This module stages the files uploaded during a data entry session and parses
+them. Each session's files are kept in a directory of their own,
+
+    <UPLOAD_FOLDER>/<url_ext>/<filename>
+
+so finding or deleting a session's files never scans other sessions' files.
+Files are parsed as CSV one row at a time, so memory use does not grow with
+the size of the file.
+
+Large files arrive from Dropzone in chunks. Each file being uploaded has an
+id chosen by the browser, and its chunks are assembled in <id>.part next to
+a <id>.json record of how many bytes have been received. A chunk must start
+where the last one ended, so an interrupted upload resumes from the received
+offset, and the file is only moved into place once its size matches the size
+the browser announced. With UPLOAD_STREAM_INGEST enabled, complete rows are
+loaded into the table as each chunk arrives and the file is never assembled;
+a row split across chunks, including at a newline within a quoted field,
+waits in the record until the rest arrives.
+
+Files left behind by sessions that expired or failed are removed by
+sweep_orphans(), which the app queues every UPLOAD_SWEEP_INTERVAL seconds.
+"""
+import io
+import os
+import re
+import csv
+import json
+import base64
+import time
+import shutil
+from werkzeug.utils import secure_filename
+from teamdict import app, sessions
+
+# Most rejected rows of each kind kept to list back to the user
+MAX_LISTED = 20
+
+# The url extensions of data entry sessions, which name their directories
+EXT_PATTERN = '[0-9a-f]+'
+
+class Rejected:
+    """
+    Tally of the rows of a load rejected for one reason, such as duplicate
+    keys or malformed rows. Every rejection is counted but only the first
+    'limit' are kept to list back to the user, so memory use stays flat
+    however many rows are rejected. Used like a list with append() and len().
+    """
+    def __init__(self, count=0, sample=(), limit=MAX_LISTED):
+        self.count = count
+        self.sample = list(sample)[:limit]
+        self.limit = limit
+
+    def append(self, item):
+        self.count += 1
+        if len(self.sample) < self.limit:
+            self.sample.append(item)
+
+    def extend(self, other):
+        """Add the rejections of another Rejected."""
+        self.count += other.count
+        room = max(0, self.limit - len(self.sample))
+        self.sample.extend(other.sample[:room])
+
+    def __len__(self):
+        return self.count
+
+    def to_dict(self):
+        return {'count': self.count, 'sample': self.sample}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['count'], data['sample'])
+
+def session_dir(ext):
+    """
+    Return the directory holding a data entry session's uploads.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Raises:
+        ValueError if ext is not a valid url extension.
+    """
+    if not re.fullmatch(EXT_PATTERN, ext):
+        raise ValueError(f'Invalid data entry extension: {ext!r}')
+    return os.path.join(app.config['UPLOAD_FOLDER'], ext)
+
+def upload_path(ext, filename):
+    """
+    Return the path an uploaded file is staged at, creating the session's
+    directory if needed.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+        filename (str): The name of the file as uploaded by the user.
+    """
+    directory = session_dir(ext)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, secure_filename(filename))
+
+def save_upload(ext, file):
+    """
+    Stage an uploaded file for a data entry session.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+        file (FileStorage): The file uploaded through flask.
+
+    Returns:
+        The path the file was saved to.
+    """
+    path = upload_path(ext, file.filename)
+    file.save(path)
+    return path
+
+def session_files(ext):
+    """
+    List the paths of the files uploaded during a data entry session.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Returns:
+        A sorted list of paths.
+    """
+    try:
+        entries = os.scandir(session_dir(ext))
+    except FileNotFoundError:
+        return []
+    with entries:
+        return sorted(entry.path for entry in entries if entry.is_file() and
+                      not entry.name.endswith(('.part', '.json', '.tmp')))
+
+def delete_session(ext):
+    """Delete every file uploaded during a data entry session."""
+    shutil.rmtree(session_dir(ext), ignore_errors=True)
+
+def sweep_orphans(max_age=None):
+    """
+    Delete the uploads of data entry sessions that have ended or expired.
+    Uploads modified within max_age seconds are kept, so files still being
+    loaded by handle_file_upload() are left alone. Only session directories
+    are considered; anything else in UPLOAD_FOLDER is never deleted.
+
+    Args:
+        max_age (int): (Optional) Seconds since an upload was last modified
+            before it may be deleted, UPLOAD_ORPHAN_AGE by default.
+
+    Returns:
+        The number of sessions' uploads deleted.
+    """
+    if max_age is None:
+        max_age = app.config['UPLOAD_ORPHAN_AGE']
+
+    cutoff = time.time() - max_age
+    try:
+        entries = os.scandir(app.config['UPLOAD_FOLDER'])
+    except FileNotFoundError:
+        return 0
+
+    deleted = 0
+    with entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or \
+                    not re.fullmatch(EXT_PATTERN, entry.name):
+                continue
+            if entry.stat().st_mtime > cutoff or \
+                    sessions.session_exists(entry.name):
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            deleted += 1
+
+    if deleted > 0:
+        app.logger.info(f'Deleted {deleted} orphaned uploads')
+    return deleted
+
+def read_rows(path, malformed, progress=None):
+    """
+    Yield the key-value pairs in an uploaded CSV file.
+
+    Args:
+        path (str): The path of the file to read.
+        malformed (Rejected): Given a 'file:line' entry for every row that
+            could not be read as a key-value pair.
+        progress (ReadProgress): (Optional) Updated as the file is read.
+
+    Yields:
+        (key, value) tuples, none if the file has already been removed
+    """
+    filename = os.path.basename(path)
+    try:
+        raw = open(path, mode='rb')
+    except FileNotFoundError:
+        return
+    with raw:
+        size = os.fstat(raw.fileno()).st_size
+        if progress is not None:
+            progress.current = raw
+        user_data = io.TextIOWrapper(raw, newline='', encoding='utf-8',
+                                     errors='replace')
+        yield from parse_rows(user_data, filename, malformed)
+
+    if progress is not None:
+        progress.current = None
+        progress.done += size
+
+class ReadProgress:
+    """
+    Tracks how many bytes of a set of uploaded files read_rows() has read.
+    """
+    def __init__(self, paths):
+        self.total = 0
+        for path in paths:
+            try:
+                self.total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        self.done = 0
+        self.current = None
+
+    @property
+    def bytes_read(self):
+        position = 0
+        if self.current is not None and not self.current.closed:
+            position = self.current.tell()
+        return min(self.total, self.done + position)
+
+def parse_rows(user_data, filename, malformed, first_line=1):
+    """
+    Yield the key-value pairs in CSV text. The first column of each row is
+    the key and the rest of the row is the value. Blank rows are skipped.
+
+    Args:
+        user_data (file): The text to parse.
+        filename (str): The name of the file the text came from.
+        malformed (Rejected): Given a 'file:line' entry for every row that
+            could not be read as a key-value pair.
+        first_line (int): (Optional) The line number of the first line.
+
+    Yields:
+        (key, value) tuples
+    """
+    reader = csv.reader(user_data)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error:
+            malformed.append(f'{filename}:{first_line - 1 + reader.line_num}')
+            continue
+
+        if len(row) == 0:
+            continue
+        key = row[0].strip()
+        if len(row) < 2 or key == '':
+            #Improper formatting for this key-value pair
+            malformed.append(f'{filename}:{first_line - 1 + reader.line_num}')
+            continue
+        yield (key, ','.join(row[1:]))
+
+class ChunkError(Exception):
+    """Raised when a chunk does not continue an upload where it left off."""
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+def upload_state_path(ext, upload_id):
+    """
+    Return the path of the record kept for a chunked upload.
+
+    Raises:
+        ValueError if upload_id is not a valid upload id.
+    """
+    if not re.fullmatch('[0-9A-Za-z-]{1,64}', upload_id):
+        raise ValueError(f'Invalid upload id: {upload_id!r}')
+    return os.path.join(session_dir(ext), f'{upload_id}.json')
+
+def load_upload_state(ext, upload_id):
+    """
+    Load the record kept for a chunked upload.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+        upload_id (str): The id the browser gave the file being uploaded.
+
+    Returns:
+        A dict with the 'offset' received so far, whether the upload is
+        'complete' and, for streamed uploads, the unparsed 'tail' of the
+        last chunk, the 'lines' parsed and the running load stats.
+    """
+    try:
+        with open(upload_state_path(ext, upload_id)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {'offset': 0, 'complete': False, 'tail': '', 'lines': 0,
+                'added': 0, 'updated': 0,
+                'duplicates': Rejected().to_dict(),
+                'malformed': Rejected().to_dict()}
+
+def save_upload_state(ext, upload_id, state):
+    """Atomically replace the record kept for a chunked upload."""
+    path = upload_state_path(ext, upload_id)
+    os.makedirs(session_dir(ext), exist_ok=True)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(path + '.tmp', path)
+
+def received_offset(ext, upload_id):
+    """Return how many bytes of a chunked upload have been received."""
+    return load_upload_state(ext, upload_id)['offset']
+
+def receive_chunk(ext, form, file, ingest=None):
+    """
+    Add a chunk sent by Dropzone to its upload.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+        form (dict): The form sent with the chunk, including Dropzone's
+            dzuuid, dzchunkbyteoffset and dztotalfilesize fields.
+        file (FileStorage): The chunk's data.
+        ingest (function): (Optional) Called with an iterable of (key, value)
+            tuples for every chunk when streaming, returning the stats of
+            loading them as db.bulk_add_data() does. If None the chunks are
+            assembled into a file for handle_file_upload() instead.
+
+    Returns:
+        A dict with the 'offset' received so far and whether the upload is
+        'complete'.
+
+    Raises:
+        ChunkError if the chunk does not start at the received offset or
+        runs past the announced size of the file.
+    """
+    upload_id = form['dzuuid']
+    offset = int(form['dzchunkbyteoffset'])
+    total = int(form['dztotalfilesize'])
+    data = file.read()
+
+    state = load_upload_state(ext, upload_id)
+    received = state['offset']
+    if received > 0 and offset + len(data) <= received:
+        # A retry of a chunk that already arrived
+        return {'offset': received, 'complete': state['complete']}
+    if offset != received:
+        raise ChunkError(f'Expected a chunk at offset {received}', received)
+    if offset + len(data) > total:
+        raise ChunkError('Chunk runs past the end of the file', received)
+
+    state['offset'] = offset + len(data)
+    state['complete'] = state['offset'] == total
+    if ingest is None:
+        append_chunk(ext, upload_id, offset, data)
+        if state['complete']:
+            os.replace(os.path.join(session_dir(ext), f'{upload_id}.part'),
+                       upload_path(ext, file.filename))
+    else:
+        stream_chunk(file.filename, data, state, ingest)
+    save_upload_state(ext, upload_id, state)
+
+    return {'offset': state['offset'], 'complete': state['complete']}
+
+def append_chunk(ext, upload_id, offset, data):
+    """Write a chunk into its upload's .part file at the given offset."""
+    os.makedirs(session_dir(ext), exist_ok=True)
+    path = os.path.join(session_dir(ext), f'{upload_id}.part')
+    mode = 'r+b' if os.path.exists(path) else 'wb'
+    with open(path, mode) as part:
+        part.seek(offset)
+        part.write(data)
+        part.truncate()
+
+def stream_chunk(filename, data, state, ingest):
+    """
+    Load the complete rows of a chunk, keeping any partial last row in the
+    upload's record until the next chunk arrives.
+    """
+    data = base64.b64decode(state['tail']) + data
+    if not state['complete']:
+        cut = last_record_end(data)
+        data, tail = data[:cut], data[cut:]
+    else:
+        tail = b''
+    state['tail'] = base64.b64encode(tail).decode('ascii')
+
+    text = data.decode('utf-8', errors='replace')
+    malformed = Rejected.from_dict(state['malformed'])
+    rows = parse_rows(io.StringIO(text, newline=''), filename,
+                      malformed, first_line=state['lines'] + 1)
+    stats = ingest(rows)
+    duplicates = Rejected.from_dict(state['duplicates'])
+    duplicates.extend(stats['duplicates'])
+    state['lines'] += text.count('\n')
+    state['added'] += stats['added']
+    state['updated'] = state.get('updated', 0) + stats['updated']
+    state['duplicates'] = duplicates.to_dict()
+    state['malformed'] = malformed.to_dict()
+
+def last_record_end(data):
+    """
+    Find where the last complete CSV record in data ends. A newline only
+    ends a record outside of a quoted field, which is when an even number of
+    quotes comes before it, as doubled quotes within a field come in pairs.
+
+    Args:
+        data (bytes): CSV text starting at the beginning of a record.
+
+    Returns:
+        The offset just past the newline ending the last complete record, 0
+        if there is none.
+    """
+    end = 0
+    quotes = 0
+    start = 0
+    while True:
+        newline = data.find(b'\n', start)
+        if newline == -1:
+            return end
+        quotes += data.count(b'"', start, newline)
+        if quotes % 2 == 0:
+            end = newline + 1
+        start = newline + 1
+
+def streamed_stats(ext):
+    """
+    Total the load stats of every upload streamed during a session.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+
+    Returns:
+        A dict with the number of rows 'added' and 'updated' and the
+        Rejected 'duplicates' and 'malformed' rows.
+    """
+    totals = {'added': 0, 'updated': 0, 'duplicates': Rejected(),
+              'malformed': Rejected()}
+    try:
+        entries = os.scandir(session_dir(ext))
+    except FileNotFoundError:
+        return totals
+    with entries:
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+            with open(entry.path) as state_file:
+                state = json.load(state_file)
+            totals['added'] += state['added']
+            totals['updated'] += state.get('updated', 0)
+            totals['duplicates'].extend(
+                    Rejected.from_dict(state['duplicates']))
+            totals['malformed'].extend(Rejected.from_dict(state['malformed']))
+    return totals
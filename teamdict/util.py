@@ -6,19 +6,43 @@ October 4, 2018
 This module contains utility functions necessary for other modules of this app.
 """
 import os
-import psycopg2.extras
-from teamdict import app
+import rq
+import time
+import functools
+from teamdict import app, envelope, metrics, sessions, uploads
+from teamdict.pool import with_connection
 from teamdict.slack import *
-from teamdict.validate import is_valid_request
 import teamdict.postgres as db
 
+CANCEL_PREFIX = 'teamdict:cancel:'
+
+def traced_job(func):
+    """
+    Decorator for jobs queued with an envelope. The envelope is decoded and
+    the request's trace is continued for the length of the job, starting
+    with the time the job spent queued, which includes forking the work
+    horse. The job function is given the decoded JobData.
+    """
+    @functools.wraps(func)
+    def wrapper(payload):
+        job_data = envelope.unpack(payload)
+        with metrics.trace(job_data.command, job_data.trace_id,
+                           process='worker') as t:
+            if job_data.sent_at is not None:
+                t.add('queue', max(0.0, time.time() - job_data.sent_at))
+            return func(job_data)
+    return wrapper
+
+@traced_job
+@flush_after
+@with_connection
 def triage_command(job_data):
     """
     Send the request to the correct function
 
     Args:
-        job_data (JobData): Object containing necessary informationr
-            headers, form, and body of the original POST request.
+        job_data (JobData): The job's envelope decoded by traced_job(),
+            holding the job type, url and form of the original POST request.
 
     Returns:
         None
@@ -28,12 +52,6 @@ def triage_command(job_data):
     response_url = form['response_url']
     slash_command = form['command']
 
-# Comment out for testing purposes
-    if not is_valid_request(job_data):
-        message = 'Access denied!'
-        send_delayed_message(message, response_url)
-        return
-
     text = form['text'].lower().split()
 
     if len(text) == 0:
@@ -54,33 +72,59 @@ def triage_command(job_data):
             db.drop_table(form)
         elif command == 'add':
             db.add_data(form)
+        elif command == 'set':
+            db.set_data(form)
         elif command == 'populate':
             url = job_data.url
             db.data_entry(form, url)
         elif command == 'delete':
             db.delete_data(form)
+        elif command == 'export':
+            db.export_table(form, job_data.url)
         else:
             #TODO: make global vars for help and usage strings
             send_help(slash_command, response_url, message='Accepted commands')
     elif slash_command[1:] == job_type == 'lookup':
         if command == 'show':
             db.show_tables(form)
-        elif len(text) <= 2:
-            db.lookup(form)
         else:
-            send_help(slash_command, response_url, message='Accepted commands')
+            db.lookup(form)
     else:
         send_help(slash_command, response_url, message='Command not found.')
 
     return
 
+def inline_lookup(form):
+    """
+    Answer a /lookup directly in the response to Slack's request when the
+    answer is already cached, skipping the job queue.
+
+    Args:
+        form (dict): Form data from the original POST request.
+
+    Returns:
+        The message payload to respond with, or None if the request must be
+        queued instead.
+    """
+    reply = db.cached_lookup(form)
+    if reply is None:
+        metrics.incr('lookup.queued')
+        return None
+
+    metrics.incr('lookup.inline')
+    message, attachments = reply
+    return build_message(message, attachments=attachments)
+
+@traced_job
+@flush_after
+@with_connection
 def triage_response(job_data):
     """
     Send the interactive response to the correct function.
 
     Args:
-        job_data (JobData): Object containing necessary informationr
-            headers, form, and body of the original POST request.
+        job_data (JobData): The job's envelope decoded by traced_job(),
+            holding the decoded interactive message payload.
 
     Returns:
         None
@@ -88,12 +132,6 @@ def triage_response(job_data):
     form = job_data.form
     response_url = form['response_url']
 
-# Comment out for testing purposes
-    if not is_valid_request(job_data):
-        message = 'Access denied!'
-        send_delayed_message(message, response_url)
-        return
-
     actions = form['actions'][0] #'actions' is an array containing only a dict
     #TODO: sanity check on this triaging
     if actions['value'] == 'cancel':
@@ -124,61 +162,211 @@ def handle_data_entry(job_data):
 
     print(f'Response from api_call: {response}')
 
+@flush_after
+@with_connection
 def handle_file_upload(**kwargs):
+    """
+    Load every file uploaded during a data entry session into its table and
+    send the user a single summary of the load. Progress is published in the
+    job's meta after every chunk, and a cancellation requested with
+    request_cancel() stops the load at the next chunk boundary, keeping the
+    chunks already committed.
+
+    Kwargs:
+        ext (str): The url extension identifying the data entry session.
+
+    Returns:
+        None
+    """
     if 'ext' not in kwargs:
         return {}
 
     ext = kwargs['ext']
-    print(f'ext at top of handle_file_upload: {ext}')
     dbrow = db.fetch_data_entry_row(ext)
-    print(f'dbrow fetched at top of handle_file_upload:\n{dbrow}')
-
-    key = ''
-    value = ''
-    form = {}
-    form['response_url'] = dbrow['response_url']
-    form['table_name'] = dbrow['table_name']
-    key_value_dict = {}
-    uploads = app.config['UPLOAD_FOLDER']
-    for filename in os.listdir(uploads):
-        print(f'filename found in uploads folder: {filename}')
-        if filename.split('_')[0] == ext:
-            with open(os.path.join(uploads, filename), mode='r') as user_data:
-                for row in user_data:
-                    data = row.rstrip('\n').split(',')
-                    if len(data) < 2:
-                        print(f'data formatted wrong: {data}')
-                        #Improper formatting for this key-value pair
-                        continue
-                    key = data[0]
-                    value = ' '.join(data[1:])
-                    key_value_dict[key] = value
-                    form['text'] = f'dbmod add table {key} {value}'
-                    print(f'running db.add_data(form) with this form:\n{form}')
-                    db.add_data(form)
-
-            os.remove(os.path.join(uploads, filename))
+    if len(dbrow) == 0:
+        # Session expired or was cancelled, nothing to load into
+        delete_uploaded_files(ext)
+        return
+
+    response_url = dbrow['response_url']
+    short_name, table_name = db.add_short_name(dbrow['table_name'])
+    malformed = uploads.Rejected()
+    paths = uploads.session_files(ext)
+    read_progress = uploads.ReadProgress(paths)
+    progress = report_progress(rq.get_current_job(), time.monotonic(),
+                               read_progress, malformed)
+    rows = read_uploaded_rows(paths, malformed, read_progress)
+    overwrite = dbrow.get('overwrite') == '1'
+    stats = db.bulk_add_data(table_name, rows, progress=progress,
+                             overwrite=overwrite)
+
+    # Include the rows loaded while their chunks were being uploaded
+    streamed = uploads.streamed_stats(ext)
+    stats['added'] += streamed['added']
+    stats['updated'] += streamed['updated']
+    stats['duplicates'].extend(streamed['duplicates'])
+    malformed.extend(streamed['malformed'])
+    delete_uploaded_files(ext)
+
+    send_upload_summary(short_name, stats, malformed, response_url)
+
+def receive_upload_chunk(ext, form, file):
+    """
+    Add a chunk of a file being uploaded during a data entry session. With
+    UPLOAD_STREAM_INGEST enabled the chunk's rows are loaded into the
+    session's table straight away. Every chunk accepted extends the
+    session's expiry.
+
+    Args:
+        ext (str): The url extension identifying the data entry session.
+        form (dict): The form sent by Dropzone with the chunk.
+        file (FileStorage): The chunk's data.
+
+    Returns:
+        A dict with the 'offset' received so far and whether the upload is
+        'complete', or None if the session does not exist or has expired.
+
+    Raises:
+        uploads.ChunkError if the chunk does not continue the upload.
+    """
+    dbrow = db.verify_ext(ext)
+    if len(dbrow) == 0:
+        return None
+
+    ingest = None
+    if app.config['UPLOAD_STREAM_INGEST']:
+        short_name, table_name = db.add_short_name(dbrow['table_name'])
+        overwrite = dbrow.get('overwrite') == '1'
+        ingest = lambda rows: db.bulk_add_data(table_name, rows,
+                                               overwrite=overwrite)
+    result = uploads.receive_chunk(ext, form, file, ingest)
+    # Keep the session alive for as long as the upload keeps arriving
+    sessions.extend_session(ext)
+    return result
+
+def read_uploaded_rows(paths, malformed, progress=None):
+    """
+    Yield the key-value pairs found in the files uploaded for a data entry
+    session, removing each file once it has been read.
+
+    Args:
+        paths (list): The paths of the session's files.
+        malformed (Rejected): Given a 'file:line' entry for every row that
+            could not be read as a key-value pair.
+        progress (ReadProgress): (Optional) Updated as the files are read.
+
+    Yields:
+        (key, value) tuples
+    """
+    for path in paths:
+        yield from uploads.read_rows(path, malformed, progress)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def report_progress(job, started, read_progress, malformed):
+    """
+    Build the callback handle_file_upload() gives db.bulk_add_data(). After
+    every chunk it publishes the load's progress in the job's meta, where the
+    data entry page polls for it, and checks whether the user has cancelled.
+
+    Args:
+        job (Job): The RQ job running the load, None outside of a worker.
+        started (float): time.monotonic() when the load started.
+        read_progress (ReadProgress): Tracks the bytes of the files read.
+        malformed (Rejected): The malformed rows found so far.
+
+    Returns:
+        A function taking the load's stats and returning False to stop.
+    """
+    def progress(stats):
+        if job is None:
+            return True
+
+        bytes_read = read_progress.bytes_read
+        elapsed = time.monotonic() - started
+        eta = None
+        if bytes_read > 0:
+            eta = elapsed * (read_progress.total - bytes_read) / bytes_read
+        job.meta['progress'] = {
+            'rows_processed': stats['rows'] + len(malformed),
+            'rows_rejected': len(stats['duplicates']) + len(malformed),
+            'bytes_read': bytes_read,
+            'bytes_total': read_progress.total,
+            'eta_seconds': eta,
+        }
+        job.save_meta()
+        return not cancel_requested(job.get_id())
+    return progress
+
+def request_cancel(job_id):
+    """
+    Ask a running upload job to stop at its next chunk boundary.
+
+    Args:
+        job_id (str): The id of the RQ job.
+
+    Returns:
+        None
+    """
+    app.redis.set(CANCEL_PREFIX + job_id, 1, ex=3600)
+
+def cancel_requested(job_id):
+    """Return True if request_cancel() has been called for the job."""
+    return app.redis.exists(CANCEL_PREFIX + job_id)
+
+def send_upload_summary(short_name, stats, malformed, response_url):
+    """
+    Send one message describing the outcome of a bulk load.
+
+    Args:
+        short_name (str): The short form name of the table loaded into.
+        stats (dict): The stats returned by db.bulk_add_data().
+        malformed (Rejected): Locations of rows that could not be read.
+        response_url (str): The url to send our response POST request to.
+
+    Returns:
+        None
+    """
+    added = stats['added']
+    updated = stats.get('updated', 0)
+    duplicates = stats['duplicates']
+    plural_s = '' if added == 1 else 's'
+    message = f'{added} key{plural_s} added to `{short_name}`'
+    if updated > 0:
+        message = f'{message}, {updated} updated'
+    if stats.get('cancelled'):
+        message = f'Import cancelled, {message} before it stopped'
+
+    details = []
+    if len(duplicates) > 0:
+        listed = ', '.join(duplicates.sample)
+        more = ' ...' if len(duplicates) > len(duplicates.sample) else ''
+        details.append(f'{len(duplicates)} duplicate keys skipped: '
+                       f'{listed}{more}')
+    if len(malformed) > 0:
+        listed = ', '.join(malformed.sample)
+        more = ' ...' if len(malformed) > len(malformed.sample) else ''
+        details.append(f'{len(malformed)} malformed rows skipped: '
+                       f'{listed}{more}')
+
+    send_delayed_message(message, response_url, attachments='\n'.join(details))
 
+@flush_after
 def handle_upload_cancellation(**kwargs):
     if 'ext' not in kwargs:
         return {}
 
     ext = kwargs['ext']
-    # Delete the database row for this file upload
-    with app.dbconn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        query = ('DELETE FROM data_entry_queue WHERE ' +
-                'url_ext = %s RETURNING *;')
-        cur.execute(query, (ext,))
-        app.dbconn.commit()
+    # End the data entry session for this file upload
+    sessions.pop_session(ext)
 
     delete_uploaded_files(ext)
 
 def delete_uploaded_files(ext):
     # Delete files associated with this upload session
-    uploads = app.config['UPLOAD_FOLDER']
-    for filename in os.listdir(uploads):
-        if filename.split('_')[0] == ext:
-            os.remove(os.path.join(uploads, filename))
+    uploads.delete_session(ext)
 
 def allowed_file(filename):
     ext = filename.rsplit('.', 1)[1].lower()
@@ -7,45 +7,108 @@ This module reviews a POST request to ensure it originated from slack. The
 computation done here complies with Slack's "Verifying requests from Slack"
 API docs page found here:
     https://api.slack.com/docs/verifying-requests-from-slack
+
+Requests are verified by the web process before they are queued. Besides the
+signature, a request must have been signed within SLACK_SIGNATURE_MAX_AGE
+seconds and its signature must not have been seen before, so a captured
+request cannot be replayed. Rejections are counted in teamdict.metrics.
 """
-import os
 import hmac
+import time
 import hashlib
+import functools
+import redis
+from flask import request
+from teamdict import app, metrics
+
+REPLAY_PREFIX = 'teamdict:signature:'
+
+def verify_slack_request(view):
+    """
+    Decorator for routes Slack POSTs to. Requests that fail verification are
+    rejected with a 401 before the view runs.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'POST':
+            reason = check_request(request.headers,
+                                   request.get_data(cache=True))
+            if reason is not None:
+                metrics.incr('slack_auth.rejected')
+                metrics.incr(f'slack_auth.rejected.{reason}')
+                app.logger.warning(f'Rejected Slack request: {reason}')
+                return ('', 401)
+        return view(*args, **kwargs)
+    return wrapper
 
-def is_valid_request(request):
+def check_request(headers, body):
     """
     Follows Slack's cryptographic method of ensuring a POST request
     originates from Slack by comparing a signature in the request to
     a signature computed with HMAC.
 
     Args:
-        request (Request): A POST request from flask.
+        headers (dict): The headers of the request.
+        body (bytes): The raw body of the request.
 
     Returns:
-        True if the request originates from Slack, False otherwise.
+        None if the request originates from Slack, otherwise the reason it was
+        rejected: 'missing', 'stale', 'signature' or 'replay'.
+    """
+    timestamp = headers.get('X-Slack-Request-Timestamp')
+    slack_signature = headers.get('X-Slack-Signature')
+    if timestamp is None or slack_signature is None:
+        return 'missing'
+
+    max_age = app.config['SLACK_SIGNATURE_MAX_AGE']
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return 'missing'
+    if age > max_age:
+        return 'stale'
+
+    computed_signature = compute_signature(timestamp, body)
+    if not hmac.compare_digest(computed_signature, slack_signature):
+        return 'signature'
+
+    if not first_use(slack_signature, max_age):
+        return 'replay'
+    return None
+
+def first_use(signature, max_age):
     """
-    computed_signature = compute_signature(request)
-    slack_signature = request.headers['X-Slack-Signature']
+    Record a signature as seen. Signatures only need to be remembered for as
+    long as their timestamps are fresh.
 
-    return hmac.compare_digest(computed_signature, slack_signature)
+    Returns:
+        False if the signature has been seen before.
+    """
+    try:
+        return bool(app.redis.set(REPLAY_PREFIX + signature, 1,
+                                  ex=2 * max_age, nx=True))
+    except redis.RedisError as e:
+        app.logger.warning(f'Replay cache unavailable: {e}')
+        return True
 
-def compute_signature(request):
+def compute_signature(timestamp, body):
     """
     Computes the SHA256 HMAC hash using the signing secret from Slack
     as the key and specific data from the POST request as the body.
 
     Args:
-        request (Request): A POST request from flask.
+        timestamp (str): The X-Slack-Request-Timestamp header.
+        body (bytes): The raw body of the request.
 
     Returns:
         Return a string containing the computed signature for verification
     """
     versionno = 'v0'
-    timestamp = request.headers['X-Slack-Request-Timestamp']
-    body = request.body
+    if isinstance(body, str):
+        body = body.encode('utf-8')
 
-    basestr = bytes(f"{versionno}:{timestamp}:{body}", 'utf-8')
-    secret = bytes(os.environ.get('SIGNING_SECRET'), 'utf-8')
+    basestr = bytes(f'{versionno}:{timestamp}:', 'utf-8') + body
+    secret = bytes(app.config['SIGNING_SECRET'], 'utf-8')
 
     # Prepend 'v0=' onto the string as the 'X-Slack-Signature also includes it.
     return 'v0=' + hmac.new(secret, basestr, hashlib.sha256).hexdigest()
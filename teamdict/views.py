@@ -6,41 +6,55 @@ October 4, 2018
 This module defines the routes for flask endpoints.
 """
 import os
+import hmac
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
 from flask import request, render_template, url_for, redirect, flash, jsonify
+from flask import Response
 from werkzeug.utils import secure_filename
 from datetime import datetime
-from teamdict import app
-from teamdict.postgres import verify_ext
-from teamdict.redis import queue_task, queue_util
+from teamdict import app, exports, metrics, uploads
+from teamdict.postgres import verify_ext, add_short_name
+from teamdict.redis import queue_task, queue_util, trace_request
 from teamdict.util import handle_upload_cancellation, handle_file_upload, allowed_file
+from teamdict.util import request_cancel
+from teamdict.util import inline_lookup, receive_upload_chunk
+from teamdict.validate import verify_slack_request
 
 @app.route('/')
 def homepage():
     return render_template('index.html')
 
 @app.route('/slack/lookup', methods=['POST', 'GET'])
+@verify_slack_request
+@trace_request('lookup')
 def lookup():
     if request.method == 'POST':
-        req_body = request.get_data(as_text=True)
-        return queue_task(request, req_body, 'lookup')
+        # Answer straight away when the lookup is cached
+        reply = inline_lookup(request.form.to_dict())
+        if reply is not None:
+            return jsonify(reply), 200
+        return queue_task(request, 'lookup')
 
     else:
         return redirect(url_for('homepage'))
 
 @app.route('/slack/modify', methods=['POST', 'GET'])
+@verify_slack_request
+@trace_request('modify')
 def modify():
     if request.method == 'POST':
-        req_body = request.get_data(as_text=True)
-        return queue_task(request, req_body, 'modify')
+        return queue_task(request, 'modify')
 
     else:
         return redirect(url_for('homepage'))
 
 @app.route('/slack/response', methods=['POST', 'GET'])
+@verify_slack_request
+@trace_request('response')
 def response():
     if request.method == 'POST':
-        req_body = request.get_data(as_text=True)
-        return queue_task(request, req_body, 'response')
+        return queue_task(request, 'response')
 
     else:
         return redirect(url_for('homepage'))
@@ -54,6 +68,19 @@ def data_entry(ext):
         if len(data) == 0:
             # Render failure page
             return ("<h1>Try again</h1>", 403)
+        elif 'dzuuid' in request.args:
+            # Ask how much of a chunked upload has arrived, to resume it
+            try:
+                offset = uploads.received_offset(ext, request.args['dzuuid'])
+            except ValueError:
+                return jsonify({'status': 'error'}), 400
+            response_json = {
+                'status': 'success',
+                'data': {
+                    'offset': offset,
+                }
+            }
+            return jsonify(response_json), 200
         elif len(data) > 0:
             # Extract data from database row
             print(data)
@@ -73,11 +100,28 @@ def data_entry(ext):
                 flash(f'Files of {ext} type are not allowed!')
                 return('', 200)
 
+            if file and 'dzuuid' in request.form:
+                # One chunk of a larger file
+                try:
+                    result = receive_upload_chunk(ext, request.form, file)
+                except ValueError:
+                    return('', 403)
+                except uploads.ChunkError as e:
+                    response_json = {
+                        'status': 'error',
+                        'message': str(e),
+                        'data': {'offset': e.offset},
+                    }
+                    return jsonify(response_json), 409
+                if result is None:
+                    return('', 403)
+                return jsonify({'status': 'success', 'data': result}), 200
+
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                print(f'saving {filename} to {os.path.join(app.config["UPLOAD_FOLDER"], ext+"_"+filename)}')
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], ext + '_' + filename))
-                print(f'os.listdir(upload_folder):\n{os.listdir(app.config["UPLOAD_FOLDER"])}')
+                try:
+                    uploads.save_upload(ext, file)
+                except ValueError:
+                    return('', 403)
                 return('', 200)
 
         # If user presses a nav button 'Continue' or 'Cancel'
@@ -90,19 +134,35 @@ def data_entry(ext):
                     response_json = queue_util(handle_file_upload, 'continue', ext=ext)
                     return jsonify(response_json), 202
                 elif navigation == 'cancel':
+                    # Stop an import already running at its next chunk. The
+                    # import cleans up the session itself once it stops, and
+                    # the page keeps polling it for its summary.
+                    if 'import_task_id' in form:
+                        task_id = form['import_task_id']
+                        request_cancel(task_id)
+                        response_json = {
+                            'status': 'success',
+                            'data': {'task_id': task_id},
+                        }
+                        return jsonify(response_json), 202
                     # Handle cancellation of file upload
                     response_json = queue_util(handle_upload_cancellation, 'cancel', ext=ext)
                     return jsonify(response_json), 202
             # Ajax request for the status of the Redis task
             elif 'task_id' in form:
                 task_id = form['task_id']
-                rq_task = app.task_queue.fetch_job(task_id)
+                # Jobs are spread across the priority queues
+                try:
+                    rq_task = Job.fetch(task_id, connection=app.redis)
+                except NoSuchJobError:
+                    rq_task = None
                 if rq_task:
                     response_json = {
                         'status': 'success',
                         'data': {
                             'task_id': task_id,
                             'task_status': rq_task.get_status(),
+                            'progress': rq_task.meta.get('progress'),
                         }
                     }
                     if rq_task.get_status() == 'finished':
@@ -110,14 +170,44 @@ def data_entry(ext):
                             response_json['data']['redirect'] = url_for('success')
                         elif rq_task.meta['type'] == 'cancel':
                             response_json['data']['redirect'] = url_for('homepage')
+                    elif rq_task.get_status() == 'failed':
+                        response_json['data']['redirect'] = url_for('homepage')
                 else:
                     response_json = {'status': 'error'}
                 return jsonify(response_json), 202
 
+@app.route('/export/<token>')
+def export(token):
+    link = exports.get_link(token)
+    if len(link) == 0:
+        return ("<h1>This export link has expired</h1>", 404)
+
+    table_name = link['table_name']
+    short_name, table_name = add_short_name(table_name)
+    mimetype, extension = exports.FORMATS[link['format']]
+    headers = {
+        'Content-Disposition':
+            f'attachment; filename="{secure_filename(short_name)}.{extension}"',
+    }
+    return Response(exports.stream_table(table_name, link['format']),
+                    mimetype=mimetype, headers=headers)
+
 @app.route('/success')
 def success():
     return render_template('success.html'), 200
 
+@app.route('/metrics')
+def show_metrics():
+    # Only served when METRICS_TOKEN is set, to requests sending it in the
+    # X-Metrics-Token header
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return ('', 404)
+    sent = request.headers.get('X-Metrics-Token', '')
+    if not hmac.compare_digest(sent.encode('utf-8'), token.encode('utf-8')):
+        return ('', 401)
+    return jsonify(metrics.summary()), 200
+
 @app.route('/test', methods=['POST', 'GET'])
 def testing():
     if request.method == 'POST':
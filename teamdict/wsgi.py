@@ -0,0 +1,13 @@
+"""
+wsgi.py
+October 18, 2026
+
+The entry point of the web process. Importing this module registers the
+app's routes, which worker processes have no use for.
+
+    gunicorn teamdict.wsgi:app
+"""
+from teamdict import app
+
+# Allow app to find @app.route views
+from teamdict import views
@@ -0,0 +1,35 @@
+"""
+Checks that command_name() only gives the names of known commands, so the
+metrics recorded for requests cannot be named by them.
+"""
+import unittest
+from teamdict.envelope import command_name
+
+class CommandNameTest(unittest.TestCase):
+    def test_known_commands(self):
+        self.assertEqual(command_name('lookup', {'command': '/lookup',
+                                                'text': 'key'}), 'lookup')
+        self.assertEqual(command_name('modify', {'command': '/dbmod',
+                                                'text': 'add t k v'}),
+                         'dbmod.add')
+        self.assertEqual(command_name('response',
+                                      {'actions': [{'value': 'drop'}]}),
+                         'response.drop')
+
+    def test_unknown_names_are_other(self):
+        self.assertEqual(command_name('modify', {'command': '/dbmod',
+                                                'text': 'attackerchosenname'}),
+                         'dbmod.other')
+        self.assertEqual(command_name('lookup', {'command': '/anything'}),
+                         'other')
+        self.assertEqual(command_name('response',
+                                      {'actions': [{'value': 'anything'}]}),
+                         'response.other')
+
+    def test_malformed_actions(self):
+        for actions in (None, [], ['drop'], {'value': 'drop'}):
+            self.assertEqual(command_name('response', {'actions': actions}),
+                             'response.other')
+
+if __name__ == '__main__':
+    unittest.main()
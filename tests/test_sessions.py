@@ -0,0 +1,135 @@
+"""
+Checks that /dbmod populate commands run at the same time each create their
+own data entry session, holding the timestamp of their own Slack message.
+Redis and Slack are replaced by in-memory stand-ins.
+"""
+import json
+import time
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from teamdict import app, cache, sessions
+import teamdict.postgres as db
+
+TEAM = 'team'
+CHANNEL = 'c1'
+TABLE = 'populate'
+
+class FakeRedis:
+    """The few Redis commands data entry sessions use, kept in a dict."""
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            if nx and key in self.data:
+                return None
+            self.data[key] = value
+            return True
+
+    def hmset(self, key, fields):
+        with self.lock:
+            stored = self.data.setdefault(key, {})
+            for field, value in fields.items():
+                stored[field.encode('utf-8')] = str(value).encode('utf-8')
+            return True
+
+    def hgetall(self, key):
+        with self.lock:
+            return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        with self.lock:
+            return key in self.data
+
+    def delete(self, key):
+        with self.lock:
+            return int(self.data.pop(key, None) is not None)
+
+class FakePipeline:
+    """Queues commands and runs them together, holding the store's lock."""
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+        return queue
+
+    def execute(self):
+        results = []
+        for command, args, kwargs in self.commands:
+            results.append(command(*args, **kwargs))
+        self.commands = []
+        return results
+
+class FakeSlack:
+    """Stands in for slack.api_call, giving every message its own timestamp."""
+    def __init__(self):
+        self.posted = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, method, **kwargs):
+        # Let other commands run between posting and creating the session
+        time.sleep(0.001)
+        with self.lock:
+            message_ts = f'{1500000000 + len(self.posted)}.000100'
+            self.posted[kwargs['user']] = message_ts
+        return {'ok': True, 'message_ts': message_ts}
+
+def populate_form(n):
+    return {
+        'text': f'populate {TABLE}',
+        'team_domain': TEAM,
+        'channel_id': CHANNEL,
+        'user_id': f'U{n:06d}',
+        'response_url': f'http://localhost/response/{n}',
+    }
+
+class DataEntryConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        prefix = cache.channel_prefix(TEAM, CHANNEL)
+        self.redis.data[cache.TABLES_PREFIX + prefix] = json.dumps(
+                [f'{prefix}_{TABLE}'])
+        # Hold the sweep lock so no sweep of orphaned uploads is queued
+        self.redis.data[sessions.SWEEP_LOCK] = b'1'
+        self.slack = FakeSlack()
+        patches = [mock.patch.object(app, 'redis', self.redis),
+                   mock.patch.object(db, 'api_call', self.slack),
+                   mock.patch.object(db, 'send_delayed_message')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_sessions_keep_their_own_message_ts(self):
+        commands = 64
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(
+                    lambda n: db.data_entry(populate_form(n),
+                                            'http://localhost/'),
+                    range(commands)))
+
+        exts = [key[len(sessions.SESSION_PREFIX):] for key in self.redis.data
+                if key.startswith(sessions.SESSION_PREFIX)]
+        self.assertEqual(len(exts), commands)
+        self.assertEqual(len(set(self.slack.posted.values())), commands)
+        for ext in exts:
+            session = sessions.pop_session(ext)
+            self.assertEqual(session['message_ts'],
+                             self.slack.posted[session['user_id']])
+            self.assertEqual(session['table_name'],
+                             f'{TEAM}_{CHANNEL}_{TABLE}')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Checks that sweep_orphans() only deletes the directories of data entry
+sessions that have ended, leaving anything else in UPLOAD_FOLDER alone.
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from teamdict import app, sessions, uploads
+
+class SweepOrphansTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        patch = mock.patch.dict(app.config, {'UPLOAD_FOLDER': self.folder})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def make(self, name, directory=True):
+        path = os.path.join(self.folder, name)
+        if directory:
+            os.mkdir(path)
+        else:
+            open(path, 'w').close()
+        old = time.time() - 7200
+        os.utime(path, (old, old))
+
+    def test_only_ended_sessions_deleted(self):
+        self.make('abc1')
+        self.make('def2')
+        self.make('notasession')
+        self.make('.gitkeep', directory=False)
+        self.make('abcd', directory=False)
+        with mock.patch.object(sessions, 'session_exists',
+                               lambda ext: ext == 'def2'):
+            deleted = uploads.sweep_orphans(max_age=3600)
+        self.assertEqual(deleted, 1)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         ['.gitkeep', 'abcd', 'def2', 'notasession'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Checks that Slack requests signed with the signing secret reach the views
+behind trace_request() and verify_slack_request(), and that others do not.
+"""
+import time
+import unittest
+from unittest import mock
+from urllib.parse import urlencode
+from teamdict import app, metrics
+# Registers the Slack routes
+from teamdict import wsgi
+from teamdict.redis import trace_request
+from teamdict.validate import compute_signature, verify_slack_request
+
+@app.route('/tests/signed', methods=['POST'])
+@verify_slack_request
+@trace_request('lookup')
+def signed_view():
+    from flask import request
+    return request.form.get('text', ''), 200
+
+class VerifySlackRequestTest(unittest.TestCase):
+    def setUp(self):
+        app.config['SIGNING_SECRET'] = 'test-signing-secret'
+        self.client = app.test_client()
+
+    def post(self, body, timestamp=None, signature=None):
+        timestamp = timestamp or str(int(time.time()))
+        if signature is None:
+            signature = compute_signature(timestamp, body.encode('utf-8'))
+        return self.client.post(
+                '/tests/signed', data=body,
+                content_type='application/x-www-form-urlencoded',
+                headers={'X-Slack-Request-Timestamp': timestamp,
+                         'X-Slack-Signature': signature})
+
+    def body(self):
+        # Unique so the replay cache never sees the signature twice
+        return urlencode({'command': '/lookup',
+                          'text': f'key {time.perf_counter()}'})
+
+    def test_signed_request_reaches_view(self):
+        body = self.body()
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_data(as_text=True).startswith('key '))
+
+    def test_bad_signature_rejected(self):
+        response = self.post(self.body(), signature='v0=' + '0' * 64)
+        self.assertEqual(response.status_code, 401)
+
+    def test_stale_request_rejected(self):
+        timestamp = str(int(time.time()) - 3600)
+        response = self.post(self.body(), timestamp=timestamp)
+        self.assertEqual(response.status_code, 401)
+
+    def test_rejected_request_not_traced(self):
+        body = urlencode({'command': '/dbmod', 'text': 'attackerchosenname'})
+        with mock.patch.object(metrics, 'trace') as trace:
+            response = self.post(body, signature='v0=' + '0' * 64)
+        self.assertEqual(response.status_code, 401)
+        trace.assert_not_called()
+
+    def test_unsigned_list_payload_rejected(self):
+        body = urlencode({'payload': '[]'})
+        response = self.client.post(
+                '/slack/response', data=body,
+                content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 401)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""
+Checks that /metrics is only served with the configured METRICS_TOKEN.
+"""
+import unittest
+from unittest import mock
+from teamdict import app, metrics
+# Registers the routes
+from teamdict import wsgi
+
+class MetricsRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        patch = mock.patch.object(metrics, 'summary', return_value={})
+        self.summary = patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(app.config.__setitem__, 'METRICS_TOKEN',
+                        app.config['METRICS_TOKEN'])
+
+    def test_disabled_without_token(self):
+        app.config['METRICS_TOKEN'] = None
+        response = self.client.get('/metrics',
+                                   headers={'X-Metrics-Token': ''})
+        self.assertEqual(response.status_code, 404)
+        self.summary.assert_not_called()
+
+    def test_wrong_token_rejected(self):
+        app.config['METRICS_TOKEN'] = 'metrics-token'
+        for headers in ({}, {'X-Metrics-Token': 'wrong'}):
+            response = self.client.get('/metrics', headers=headers)
+            self.assertEqual(response.status_code, 401)
+        self.summary.assert_not_called()
+
+    def test_token_accepted(self):
+        app.config['METRICS_TOKEN'] = 'metrics-token'
+        response = self.client.get('/metrics',
+                                   headers={'X-Metrics-Token': 'metrics-token'})
+        self.assertEqual(response.status_code, 200)
+        self.summary.assert_called_once_with()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,217 @@
 import os
 import redis
-from rq import Worker, Queue, Connection
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from rq import Worker, SimpleWorker, Queue, Connection
+from rq.exceptions import DequeueTimeout
+from rq.registry import StartedJobRegistry
+from rq.timeouts import BaseDeathPenalty
+from rq.worker import StopRequested, WorkerStatus
+from rq.utils import current_timestamp, utcnow
 
 listen = ['high', 'default', 'low']
 
 redis_url = os.getenv('REDIS_URL', 'redis://')
 
-conn = redis.from_url(redis_url)
+# Jobs run at once by each high and default queue worker, 0 to fork a work
+# horse per job instead
+threads = int(os.getenv('WORKER_THREADS', 0))
 
-if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(map(Queue, listen))
+class MeteredWorker(Worker):
+    """Worker recording how long each job waited in its queue."""
+    def perform_job(self, job, queue):
+        from teamdict import metrics
+        if job.enqueued_at is not None:
+            wait = (utcnow() - job.enqueued_at).total_seconds()
+            metrics.record_timing(f'queue.wait.{queue.name}', wait)
+        return super().perform_job(job, queue)
+
+class ThreadDeathPenalty(BaseDeathPenalty):
+    """
+    Job timeouts rely on SIGALRM, which only the main thread can receive, and
+    a thread cannot be stopped from outside, so jobs run on threads are
+    bounded by the database and Slack timeouts instead. Long bulk loads on
+    the low queue are always run by forking workers, where the timeout
+    holds.
+    """
+    def setup_death_penalty(self):
+        pass
+
+    def cancel_death_penalty(self):
+        pass
+
+class ThreadedWorker(MeteredWorker, SimpleWorker):
+    """
+    Worker running up to 'threads' jobs at once on a pool of threads in its
+    own process. Nothing is forked, so the app is imported once and its
+    database and Slack connections are kept between jobs. Suited to jobs
+    that spend their time waiting on I/O; DB_POOL_MAX should be at least
+    'threads'.
+
+    A job is only taken off its queue once a thread is free for it, so jobs
+    stay queued where other workers can take them. While jobs run, the main
+    thread polls its queues every job_monitoring_interval seconds and keeps
+    the worker and the running jobs' StartedJobRegistry entries alive.
+    """
+    death_penalty_class = ThreadDeathPenalty
+
+    def __init__(self, *args, threads=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(threads)
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._local = threading.local()
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # Wait for a free thread before taking a job off its queue
+        while not self._slots.acquire(timeout=self.job_monitoring_interval):
+            self.maintain_running_jobs()
+            if self._stop_requested:
+                raise StopRequested()
+
+        try:
+            result = self.dequeue_job(timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        if result is None:
+            self._slots.release()
+        return result
+
+    def dequeue_job(self, timeout):
+        """
+        Wait for a job like Worker.dequeue_job_and_maintain_ttl(), waking up
+        every job_monitoring_interval seconds to keep the running jobs alive.
+        """
+        qnames = ','.join(self.queue_names())
+        self.procline('Listening on ' + qnames)
+        self.set_state(WorkerStatus.IDLE)
+
+        while True:
+            self.maintain_running_jobs()
+            if self._stop_requested:
+                raise StopRequested()
+            poll = timeout
+            if timeout is not None:
+                poll = min(timeout, self.job_monitoring_interval)
+            try:
+                result = self.queue_class.dequeue_any(
+                        self.queues, poll, connection=self.connection,
+                        job_class=self.job_class)
+                break
+            except DequeueTimeout:
+                pass
+
+        self.maintain_running_jobs()
+        return result
+
+    def maintain_running_jobs(self):
+        """
+        Send the worker's heartbeat and push back the expiry of the running
+        jobs in their StartedJobRegistry, so neither expires while jobs run
+        however long the main thread waits on the queues.
+        """
+        with self._running_lock:
+            running = list(self._running.values())
+        if len(running) == 0:
+            self.heartbeat()
+            return
+
+        expires = current_timestamp() + self.job_monitoring_interval * 2 + 60
+        with self.connection._pipeline() as pipeline:
+            self.heartbeat(pipeline=pipeline)
+            for job in running:
+                registry = StartedJobRegistry(job.origin, self.connection,
+                                              job_class=self.job_class)
+                # XX so a job that has just finished is not added back
+                pipeline.execute_command('ZADD', registry.key, 'XX',
+                                         expires, job.id)
+            pipeline.execute()
+
+    def execute_job(self, job, queue):
+        # The slot was taken in dequeue_job_and_maintain_ttl()
+        self.executor.submit(self.run_job, job, queue)
+
+    def run_job(self, job, queue):
+        self._local.job = job
+        with self._running_lock:
+            self._running[job.id] = job
+        try:
+            self.perform_job(job, queue)
+        finally:
+            with self._running_lock:
+                self._running.pop(job.id, None)
+            self._local.job = None
+            self._slots.release()
+
+    def set_current_job_id(self, job_id, pipeline=None):
+        """
+        Jobs on other threads share the worker's single current_job field,
+        so when one finishes the field is moved to a job still running
+        rather than cleared.
+        """
+        if job_id is None:
+            finished = getattr(self._local, 'job', None)
+            with self._running_lock:
+                others = [i for i in self._running
+                          if finished is None or i != finished.id]
+            if len(others) > 0:
+                job_id = others[0]
+        super().set_current_job_id(job_id, pipeline=pipeline)
+
+    def set_state(self, state, pipeline=None):
+        # The worker stays busy while any of its threads runs a job
+        if state == WorkerStatus.IDLE and len(self._running) > 0:
+            state = WorkerStatus.BUSY
+        super().set_state(state, pipeline=pipeline)
+
+    def register_death(self):
+        # Let the running jobs finish before leaving
+        self.executor.shutdown(wait=True)
+        super().register_death()
+
+def worker_counts(setting):
+    """
+    Parse the WORKERS setting, e.g. 'high=2,default=1,low=1', into the
+    number of workers to run for each queue.
+    """
+    counts = {}
+    for part in setting.split(','):
+        name, count = part.split('=')
+        if name.strip() not in listen:
+            raise ValueError(f'Unknown queue: {name}')
+        counts[name.strip()] = int(count)
+    return counts
+
+def work(queue_name):
+    """
+    Run a worker for a queue. The worker also takes jobs from the queues of
+    higher priority when they are waiting, but never from lower ones, so a
+    long job on the low queue cannot hold up interactive jobs.
+    """
+    names = listen[:listen.index(queue_name) + 1]
+    with Connection(redis.from_url(redis_url)):
+        queues = [Queue(name) for name in names]
+        # Bulk loads on the low queue need the timeout only a work horse
+        # can enforce, so low queue workers always fork
+        if threads > 0 and queue_name != 'low':
+            # Set the app up once, before jobs start on several threads
+            importlib.import_module('teamdict')
+            worker = ThreadedWorker(queues, threads=threads)
+        else:
+            worker = MeteredWorker(queues)
         worker.work()
 
+if __name__ == '__main__':
+    counts = worker_counts(os.getenv('WORKERS', 'high=1,default=1,low=1'))
+    processes = []
+    for queue_name, count in counts.items():
+        for i in range(count):
+            process = multiprocessing.Process(target=work, args=(queue_name,))
+            process.start()
+            processes.append(process)
+    for process in processes:
+        process.join()